@@ -1,14 +1,17 @@
 import pandas as pd
-from lazypredict.Supervised import LazyRegressor
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_squared_error, r2_score
-from sklearn.preprocessing import StandardScaler
 from sklearn.feature_selection import SelectKBest, f_regression
 import matplotlib.pyplot as plt
+import os
+
+from benchmark_models import append_leaderboard, run_benchmark, select_estimators
+from config_loader import MODELS_DIR, ConfigLoader
+from dataset import MODEL_COLUMNS, file_version, load_processed_data
+from features import TARGET, VisitFeatureEncoder
 
 # load df
-file_path = "/home/tomas/GitHub/ITHS-AI/data/df.xlsx"
-df = pd.read_excel(file_path)
+df = load_processed_data(columns=MODEL_COLUMNS)
 
 #filter"no match"
 df_filtered = df[df['Information'] != 'no match']
@@ -43,23 +46,13 @@ plt.tight_layout()
 plt.show()
 
 #LazyPredict
-# features and target
-df_features = df_filtered[['Activities.ActivityCategory', 'Activities.doubleStaffing', 'gender',  'ageSpan', 'SpanDistanceM', 'SpanCarStartTime']]
-
-# normalise numerical features
-scaler = StandardScaler()
-numeric_features = ['SpanDistanceM', 'SpanCarStartTime']  
-df_features[numeric_features] = scaler.fit_transform(df_features[numeric_features])
-
-# encode categorical features
-activity_category_means = df_filtered.groupby('Activities.ActivityCategory')['DurationMin'].mean()# map Activities.ActivityCategory toits  mean
-df_features['Activities.ActivityCategory'] = df_features['Activities.ActivityCategory'].map(activity_category_means)
-
-# one-hot encode other categorical columns
-categorical_features = ['Activities.doubleStaffing', 'gender', 'ageSpan']
-df_features = pd.get_dummies(df_features, columns=categorical_features, drop_first=True)#drop one dummy
+# features and target: Activities.ActivityCategory mapped to its mean, normalised numerical features, one-hot for the rest (drop one dummy)
+encoder = VisitFeatureEncoder(categorical_features=['Activities.doubleStaffing', 'gender', 'ageSpan'], numeric_features=['SpanDistanceM', 'SpanCarStartTime'], target_encode_activity=True)
+encoder.fit(df_filtered, df_filtered[TARGET])
+encoder.save(os.path.join(MODELS_DIR, "LazyPredict-features.joblib"))
+df_features = encoder.transform(df_filtered)
 
-target = df_filtered['DurationMin']
+target = df_filtered[TARGET]
 
 # train/test
 x_train, x_test, y_train, y_test = train_test_split(df_features, target, test_size=0.2, random_state=42)
@@ -70,13 +63,16 @@ df_features_selected = selector.fit_transform(df_features, target)
 selected_features = df_features.columns[selector.get_support()]
 print("Selected Features:", selected_features)
 
-# LazyPredict
+# LazyPredict models, each in its own process with time/memory budgets from config.yaml model_benchmark
 print("\n LazyPredict")
-regressor = LazyRegressor(verbose=0, ignore_warnings=True, custom_metric=None)
-models, predictions = regressor.fit(x_train, x_test, y_train, y_test)
+config = ConfigLoader()
+benchmark = config.config.get('model_benchmark', {})
+estimators = select_estimators(benchmark.get('estimators'), benchmark.get('exclude', []))
+models = run_benchmark(x_train, x_test, y_train, y_test, estimators, time_budget_s=benchmark.get('time_budget_s', 120), memory_budget_mb=benchmark.get('memory_budget_mb'), workers=benchmark.get('workers', 1))
 print(models)
+append_leaderboard(models, os.path.join(config.get_data_dir(), benchmark.get('leaderboard', "LazyPredict-leaderboard.csv")), file_version(config.get_processed_file_path()))
 
-output_file = "/home/tomas/GitHub/ITHS-AI/data/lazypredict_results_standard_scaled.xlsx" 
-with pd.ExcelWriter(output_file) as writer:
-    models.to_excel(writer, sheet_name="Model Comparison")
-    predictions.to_excel(writer, sheet_name="Predictions")
+if config.config.get('export_excel'):
+    output_file = os.path.join(config.get_data_dir(), "lazypredict_results_standard_scaled.xlsx")
+    with pd.ExcelWriter(output_file) as writer:
+        models.to_excel(writer, sheet_name="Model Comparison")
@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import pickle
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from lazypredict.Supervised import REGRESSORS
+from sklearn.impute import SimpleImputer
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+try:
+    import resource#memory budgets need setrlimit, which Windows doesn't have
+except ImportError:
+    resource = None
+
+LEADERBOARD_COLUMNS = ['run_id', 'dataset_version', 'model', 'status', 'r2', 'adjusted_r2', 'rmse', 'fit_time_s', 'predict_ms_per_row', 'model_size_bytes', 'peak_rss_mb', 'n_train', 'n_test', 'error']
+
+def select_estimators(names=None, exclude=()):#LazyRegressor's estimator list, narrowed to the configured names
+    available = dict(REGRESSORS)
+    if names:
+        unknown = sorted(set(names) - set(available))
+        if unknown:
+            raise ValueError(f"Unknown LazyPredict regressors: {unknown}")
+        return [(name, available[name]) for name in names]
+    return [(name, estimator) for name, estimator in REGRESSORS if name not in set(exclude)]
+
+def _fit_and_score(name, estimator_class, x_train, x_test, y_train, y_test, memory_budget_mb, sender):#runs in its own process
+    result = {'model': name, 'n_train': len(x_train), 'n_test': len(x_test)}
+    try:
+        if memory_budget_mb and resource is not None:
+            _, hard = resource.getrlimit(resource.RLIMIT_AS)
+            resource.setrlimit(resource.RLIMIT_AS, (int(memory_budget_mb * 1024 * 1024), hard))
+        estimator = estimator_class()
+        if 'random_state' in estimator.get_params():
+            estimator.set_params(random_state=42)
+        model = Pipeline([('imputer', SimpleImputer()), ('scaler', StandardScaler()), ('regressor', estimator)])#same preprocessing LazyRegressor applies to numeric columns
+
+        start = time.perf_counter()
+        model.fit(x_train, y_train)
+        fit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        y_pred = model.predict(x_test)
+        predict_time = time.perf_counter() - start
+
+        r2 = r2_score(y_test, y_pred)
+        n, p = x_test.shape
+        result.update({
+            'status': 'ok',
+            'r2': r2,
+            'adjusted_r2': 1 - (1 - r2) * (n - 1) / (n - p - 1) if n - p - 1 > 0 else np.nan,
+            'rmse': np.sqrt(mean_squared_error(y_test, y_pred)),
+            'fit_time_s': fit_time,
+            'predict_ms_per_row': predict_time * 1000 / max(n, 1),
+            'model_size_bytes': len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)),
+        })
+    except MemoryError:
+        result.update({'status': 'memory_budget', 'error': f"exceeded {memory_budget_mb} MB"})
+    except Exception as e:
+        result.update({'status': 'failed', 'error': f"{type(e).__name__}: {e}"[:300]})
+    if resource is not None:
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if os.uname().sysname == 'Darwin' else 1024)
+    sender.send(result)
+    sender.close()
+
+# Every estimator is fitted in its own process (at most `workers` at a time), killed when it runs past time_budget_s
+def run_benchmark(x_train, x_test, y_train, y_test, estimators, time_budget_s=120, memory_budget_mb=None, workers=1):
+    x_train, x_test = np.asarray(x_train, dtype=float), np.asarray(x_test, dtype=float)
+    y_train, y_test = np.asarray(y_train, dtype=float), np.asarray(y_test, dtype=float)
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    pending = list(estimators)
+    running = {}
+    results = []
+    while pending or running:
+        while pending and len(running) < workers:
+            name, estimator_class = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_fit_and_score, args=(name, estimator_class, x_train, x_test, y_train, y_test, memory_budget_mb, sender), daemon=True)
+            process.start()
+            sender.close()
+            running[name] = (process, receiver, time.perf_counter())
+
+        for name, (process, receiver, started) in list(running.items()):
+            if receiver.poll():
+                try:
+                    result = receiver.recv()
+                except EOFError:#worker died before reporting (e.g. killed by the OS)
+                    result = {'model': name, 'status': 'failed', 'error': f"worker exited with code {process.exitcode}"}
+            elif not process.is_alive():
+                result = {'model': name, 'status': 'failed', 'error': f"worker exited with code {process.exitcode}"}
+            elif time.perf_counter() - started > time_budget_s:
+                process.kill()
+                result = {'model': name, 'status': 'time_budget', 'error': f"exceeded {time_budget_s} s"}
+            else:
+                continue
+            process.join()
+            receiver.close()
+            del running[name]
+            results.append(result)
+            print(f"{name}: {result['status']}" + (f" R2={result['r2']:.4f} fit={result['fit_time_s']:.2f}s" if result['status'] == 'ok' else f" ({result.get('error')})"))
+        time.sleep(0.05)
+
+    leaderboard = pd.DataFrame(results).reindex(columns=LEADERBOARD_COLUMNS[2:])
+    return leaderboard.sort_values('r2', ascending=False, na_position='last').reset_index(drop=True)
+
+def append_leaderboard(leaderboard, leaderboard_path, dataset_version):#one row per model per run, kept across runs
+    leaderboard = leaderboard.copy()
+    leaderboard.insert(0, 'dataset_version', dataset_version)
+    leaderboard.insert(0, 'run_id', datetime.now().strftime('%Y-%m-%dT%H:%M:%S'))
+    leaderboard = leaderboard.reindex(columns=LEADERBOARD_COLUMNS)
+    leaderboard.to_csv(leaderboard_path, mode='a', header=not os.path.exists(leaderboard_path), index=False)
+    print(f"Leaderboard appended to {leaderboard_path}")
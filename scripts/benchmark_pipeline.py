@@ -0,0 +1,241 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+try:
+    import resource#peak RSS on Linux/macOS, Windows doesn't have it
+except ImportError:
+    resource = None
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+
+from config_loader import ConfigLoader
+from dataset import MODEL_COLUMNS, load_processed_data
+from features import TARGET, VisitFeatureEncoder
+from preprocess_data import CACHED_SHEETS, car_trip_days, load_data, preprocess_data, process_daily_data, process_daily_data_streaming, read_car_trip_chunks, save_results, sheet_cache_paths
+
+SIZES = ['7x50x5', '30x200x20', '90x500x50'] # days x patients x cars
+STAGES = ['load_data', 'load_data_cached', 'preprocess_data', 'process_daily_data', 'process_daily_data_streaming', 'save_results', 'train_random_forest']
+REGRESSION_TOLERANCE = 0.25 # --baseline flags stages whose rows/sec dropped by more than this share
+BASE_LATITUDE, BASE_LONGITUDE = 59.33, 18.06 # patients are spread over a ~5 km square around here
+AREA_DEGREES = 0.05
+UNMATCHED_SHARE = 0.1 # visits whose car parks too far away, so Information != 'match' shows up like in the real data
+ACTIVITY_CATEGORIES = ['Personlig omvårdnad', 'Hemsjukvård', 'Tillsyn', 'Städ', 'Inköp', 'Måltid']
+GENDERS = ['Man', 'Kvinna']
+AGE_SPANS = ['65-69', '70-74', '75-79', '80-84', '85-89', '90+']
+
+def parse_size(size):#'30x200x20' -> (days, patients, cars)
+    days, patients, cars = (int(part) for part in size.lower().split('x'))
+    return days, patients, cars
+
+# Sheets shaped like allData2.xlsx (raw, before parse_workbook types them), cars drive between patients and park next to them during the visit
+def synthetic_workbook(days, patients, cars, seed=0):
+    rng = np.random.default_rng(seed)
+    patient_lat = BASE_LATITUDE + rng.uniform(0, AREA_DEGREES, patients)
+    patient_lon = BASE_LONGITUDE + rng.uniform(0, AREA_DEGREES, patients)
+    patient_location = pd.DataFrame({'id': np.arange(patients), 'latitude': patient_lat, 'longitude': patient_lon})
+    patients_demographics = pd.DataFrame({
+        'careEpisodeID': np.arange(patients),
+        'demographics': [json.dumps({'gender': gender, 'ageSpan': age}) for gender, age in zip(rng.choice(GENDERS, patients), rng.choice(AGE_SPANS, patients))],
+    })
+
+    visits = {'visitId': [], 'CareEpisodeID': [], 'TravelToVisitStarted.StartTime': [], 'VisitFinished.event_data.finishedAt': []}
+    trips = {'id.1': [], 'location.latitude': [], 'location.longitude': [], 'location.timestamp': [], 'location.1.latitude': [], 'location.1.longitude': [], 'location.1.timestamp': []}
+    first_day = pd.Timestamp('2024-01-01 07:00')
+    for day in range(days):
+        for car in range(cars):
+            n = int(rng.integers(4, 10))
+            patient = rng.integers(0, patients, n)
+            travel = rng.integers(5, 20, n)#minutes driving to the visit
+            duration = rng.integers(10, 60, n)
+            pause = rng.integers(0, 20, n)
+            offsets = np.cumsum(travel + duration + pause) - duration - pause#arrival minute of each visit
+            start = first_day + pd.Timedelta(days=day) + pd.to_timedelta(rng.integers(0, 60) + offsets - travel, unit='min')
+            arrival = start + pd.to_timedelta(travel, unit='min')
+            finished = arrival + pd.to_timedelta(duration, unit='min')
+            far = rng.random(n) < UNMATCHED_SHARE
+            park_lat = patient_lat[patient] + rng.normal(0, 0.0003, n) + far * 0.01
+            park_lon = patient_lon[patient] + rng.normal(0, 0.0003, n)
+            previous_lat = np.r_[BASE_LATITUDE, park_lat[:-1]]
+            previous_lon = np.r_[BASE_LONGITUDE, park_lon[:-1]]
+
+            visits['visitId'].extend(f"v{day}-{car}-{i}" for i in range(n))
+            visits['CareEpisodeID'].extend(patient)
+            visits['TravelToVisitStarted.StartTime'].extend(start)
+            visits['VisitFinished.event_data.finishedAt'].extend(finished.strftime('%Y-%m-%dT%H:%M:%S.000Z'))#ISO text with a timezone like the export, preprocess_data parses and drops it
+            trips['id.1'].extend([f"car{car}"] * n)
+            trips['location.latitude'].extend(previous_lat)
+            trips['location.longitude'].extend(previous_lon)
+            trips['location.timestamp'].extend(start)
+            trips['location.1.latitude'].extend(park_lat)
+            trips['location.1.longitude'].extend(park_lon)
+            trips['location.1.timestamp'].extend(arrival)
+
+    finished_visits = pd.DataFrame(visits)
+    car_trips = pd.DataFrame(trips)
+    car_trips.insert(0, 'id', np.arange(len(car_trips)))
+    finished_occurrences = pd.DataFrame({
+        'ActivityOccurenceEvents.event_data.visitId': finished_visits['visitId'],
+        'Activities.ActivityCategory': rng.choice(ACTIVITY_CATEGORIES + [None], len(finished_visits)),#missing ones fall back to the title
+        'Activities.title': rng.choice(ACTIVITY_CATEGORIES, len(finished_visits)),
+        'Activities.doubleStaffing': rng.random(len(finished_visits)) < 0.1,
+    })
+    return {'finishedOccurrences': finished_occurrences, 'finishedVisits': finished_visits, 'carTrips': car_trips, 'pLocation': patient_location, 'patientsDemographics': patients_demographics}
+
+def write_workbook(sheets, file_path):
+    with pd.ExcelWriter(file_path) as writer:
+        for name, frame in sheets.items():
+            frame.to_excel(writer, sheet_name=name, index=False)
+
+def _proc_status_mb(field):#VmRSS/VmHWM from /proc/self/status (Linux), None elsewhere
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():#restart the high-water mark at the current RSS (Linux), so the peak covers only what runs next
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def max_rss_mb():#peak RSS since reset_peak_rss where it worked, else since the process started, None on Windows
+    peak = _proc_status_mb('VmHWM')
+    if peak is not None or resource is None:
+        return peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if platform.system() == 'Darwin' else 1024)
+
+def current_rss_mb():
+    rss = _proc_status_mb('VmRSS')
+    return rss if rss is not None else max_rss_mb()#without /proc the earlier peak is the closest we get
+
+def prepare_stage(stage, sheets, work_dir):#untimed setup, returns (callable, rows it handles)
+    workbook = os.path.join(work_dir, 'allData2.xlsx')
+    processed = os.path.join(work_dir, 'df.parquet')
+    if stage == 'load_data':
+        return lambda: load_data(workbook, cache_dir=False), sum(len(frame) for frame in sheets.values())
+    if stage == 'load_data_cached':
+        load_data(workbook, cache_dir=os.path.join(work_dir, 'cache'))#fill the Parquet cache first
+        return lambda: load_data(workbook, cache_dir=os.path.join(work_dir, 'cache')), sum(len(frame) for frame in sheets.values())
+
+    streaming = stage == 'process_daily_data_streaming'#the car trips are never loaded whole, or the stage's memory would include them
+    finished_occurrences, finished_visits, car_trips, patient_location, patient_demographics = load_data(workbook, cache_dir=os.path.join(work_dir, 'cache'), with_car_trips=not streaming)
+    if stage == 'preprocess_data':
+        return lambda: preprocess_data(finished_visits, patient_location, patient_demographics), len(finished_visits)
+    df = preprocess_data(finished_visits, patient_location, patient_demographics)
+    if stage == 'process_daily_data':
+        return lambda: process_daily_data(df, car_trips), len(df)
+    if streaming:#car trips read back from the cached sheet in chunks
+        car_trips_path = sheet_cache_paths(workbook, os.path.join(work_dir, 'cache'))[CACHED_SHEETS.index('carTrips')]
+        return lambda: process_daily_data_streaming(df, car_trip_days(read_car_trip_chunks(car_trips_path))), len(df)
+    distance_df = process_daily_data(df, car_trips)
+    if stage == 'save_results':
+        return lambda: save_results(df, distance_df, finished_occurrences, processed), len(distance_df)
+    if stage == 'train_random_forest':#same steps as randomForest.py, without the cross-validation and plots
+        save_results(df, distance_df, finished_occurrences, processed)
+        model_df = load_processed_data(processed, columns=MODEL_COLUMNS)
+        model_df = model_df[model_df['Information'] == 'match']
+        params = ConfigLoader().get_model_params('random_forest')
+        def train():
+            encoder = VisitFeatureEncoder().fit(model_df, model_df[TARGET])
+            RandomForestRegressor(**params).fit(encoder.transform(model_df), model_df[TARGET])
+        return train, len(model_df)
+    raise ValueError(f"Unknown stage '{stage}', expected one of {STAGES}")
+
+def _run_stage(stage, sheets, work_dir, sender):#fresh process per stage, peak_growth_mb is the stage's peak over the RSS it started from
+    try:
+        run, rows = prepare_stage(stage, sheets, work_dir)
+        isolated = reset_peak_rss()
+        rss_before = current_rss_mb()#setup data and memory inherited from the parent, not the stage's own
+        start = time.perf_counter()
+        run()
+        wall = time.perf_counter() - start
+        rss_after = max_rss_mb()
+        growth = rss_after - rss_before if rss_after is not None else None
+        sender.send({'rows': rows, 'wall_s': wall, 'rows_per_s': rows / wall if wall > 0 else None, 'peak_rss_mb': rss_after, 'peak_growth_mb': growth, 'peak_isolated': isolated})
+    except Exception as e:
+        sender.send({'error': f"{type(e).__name__}: {e}"})
+    sender.close()
+
+def run_benchmarks(sizes=SIZES, stages=STAGES, seed=0):
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    results = []
+    for size in sizes:
+        days, patients, cars = parse_size(size)
+        sheets = synthetic_workbook(days, patients, cars, seed=seed)
+        with tempfile.TemporaryDirectory() as work_dir:
+            write_workbook(sheets, os.path.join(work_dir, 'allData2.xlsx'))
+            for stage in stages:
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=_run_stage, args=(stage, sheets, work_dir, sender))
+                process.start()
+                sender.close()
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    result = {'error': f"worker exited with code {process.exitcode}"}
+                process.join()
+                result = {'stage': stage, 'size': size, 'days': days, 'patients': patients, 'cars': cars, **result}
+                results.append(result)
+                if 'error' in result:
+                    print(f"{size} {stage}: {result['error']}")
+                else:
+                    memory = f", peak RSS growth {result['peak_growth_mb']:.0f} MB" if result['peak_growth_mb'] is not None else ""
+                    print(f"{size} {stage}: {result['wall_s']:.3f} s, {result['rows_per_s']:.0f} rows/s{memory}")
+    return results
+
+def find_regressions(results, baseline_results, tolerance=REGRESSION_TOLERANCE):#stages whose throughput dropped against an earlier report
+    baseline = {(result['stage'], result['size']): result for result in baseline_results if result.get('rows_per_s')}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result['stage'], result['size']))
+        if previous and result.get('rows_per_s') and result['rows_per_s'] < previous['rows_per_s'] * (1 - tolerance):
+            regressions.append({'stage': result['stage'], 'size': result['size'], 'rows_per_s': result['rows_per_s'], 'baseline_rows_per_s': previous['rows_per_s']})
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the preprocessing and training stages on synthetic data")
+    parser.add_argument('--sizes', nargs='+', default=SIZES, help="DAYSxPATIENTSxCARS, e.g. 30x200x20")
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON report, defaults to data/benchmarks/pipeline-<timestamp>.json")
+    parser.add_argument('--baseline', help="earlier JSON report, exits with 1 when a stage got slower than --tolerance")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args()
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'seed': args.seed,
+        'results': run_benchmarks(args.sizes, args.stages, args.seed),
+    }
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            report['regressions'] = find_regressions(report['results'], json.load(file)['results'], args.tolerance)
+
+    output = args.output or os.path.join(ConfigLoader().get_data_dir(), 'benchmarks', f"pipeline-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Benchmark report written to {output}")
+
+    for regression in report.get('regressions', []):
+        print(f"Regression: {regression['size']} {regression['stage']} {regression['rows_per_s']:.0f} rows/s, was {regression['baseline_rows_per_s']:.0f}")
+    if report.get('regressions'):
+        sys.exit(1)
@@ -0,0 +1,44 @@
+import os
+
+import yaml
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'config.yaml')
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models')
+
+# ConfigLoader Class
+class ConfigLoader:
+    def __init__(self, config_path=CONFIG_PATH):
+        self.config_path = config_path
+        self.config = self._load_config()
+
+    def _load_config(self):
+        with open(self.config_path, 'r') as file:
+            return yaml.safe_load(file)
+
+    def _get_os_path(self, key):
+        if os.name == 'nt':  # Windows
+            return self.config[key]['windows']
+        elif os.uname().sysname == 'Darwin':  # macOS
+            return self.config[key]['mac']
+        else:  # Assume Linux
+            return self.config[key]['linux']
+
+    def get_file_path(self):
+        return self._get_os_path('file_paths')
+
+    def get_output_file_path(self):
+        return self._get_os_path('output_file_path')
+
+    def get_processed_file_path(self):
+        return self._get_os_path('processed_file_path')
+
+    def get_data_dir(self):
+        return os.path.dirname(self.get_processed_file_path())
+
+    def get_model_params(self, model_name):#config params, overridden by the tuned ones if a search has been run
+        params = dict(self.config.get(model_name, {}).get('params') or {})
+        best_params_path = os.path.join(MODELS_DIR, f"{model_name}-best-params.yaml")
+        if os.path.exists(best_params_path):
+            with open(best_params_path, 'r') as file:
+                params.update(yaml.safe_load(file) or {})
+        return params
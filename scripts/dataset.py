@@ -0,0 +1,53 @@
+import hashlib
+
+import pandas as pd
+
+from config_loader import ConfigLoader
+
+MODEL_COLUMNS = ['Information', 'DurationMin', 'Activities.ActivityCategory', 'Activities.doubleStaffing', 'gender', 'ageSpan', 'SpanDistanceM', 'SpanCarStartTime'] # what the model scripts read
+CATEGORY_MAX_UNIQUE_RATIO = 0.5 # text columns with fewer distinct values than this share of rows are stored dictionary-encoded
+MIXED_KINDS = ('mixed', 'mixed-integer') # pd.api.types.infer_dtype results of object columns Parquet can't store (e.g. numbers and text)
+
+def text_if_mixed(values):#object column mixing numbers and text -> all text (missing values kept), anything else unchanged
+    if pd.api.types.is_object_dtype(values) and pd.api.types.infer_dtype(values, skipna=True) in MIXED_KINDS:
+        return values.map(str, na_action='ignore')
+    return values
+
+def to_categoricals(df):#repeated text (activity categories, gender, ageSpan, Information...) becomes category, Parquet keeps it dictionary-encoded
+    df = df.copy()
+    for column in df.columns:
+        df[column] = text_if_mixed(df[column])#categories of one type only
+        if (pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column])) and df[column].nunique(dropna=True) <= CATEGORY_MAX_UNIQUE_RATIO * len(df):
+            df[column] = df[column].astype('category')
+    return df
+
+def apply_schema(df, schema):#cast the columns a schema names (missing ones are skipped), see preprocess_data.SHEET_SCHEMAS
+    df = df.copy()
+    for column, kind in schema.items():
+        if column not in df.columns:
+            continue
+        values = df[column]
+        if kind == 'id':#integer ids are downcast, text ids stay as they are so merge keys keep matching dtypes
+            if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values) and values.notna().all() and (values % 1 == 0).all():
+                df[column] = pd.to_numeric(values, downcast='integer')
+        elif kind == 'datetime':
+            df[column] = pd.to_datetime(values)
+        else:#'category', a CategoricalDtype, or a numpy dtype such as 'float32'
+            df[column] = values.astype(kind)
+    return df
+
+def save_processed_data(df, processed_file_path):
+    to_categoricals(df).to_parquet(processed_file_path, index=False)
+    print(f"Processed data saved to {processed_file_path}")
+
+def file_version(path):#short content hash, so leaderboard rows and registered models can be tied to the data they came from
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+def load_processed_data(processed_file_path=None, columns=None):#shared loader for the model and plotting scripts, columns= reads only what the script needs
+    if processed_file_path is None:
+        processed_file_path = ConfigLoader().get_processed_file_path()
+    return pd.read_parquet(processed_file_path, columns=columns)
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import cross_validate
+
+def regression_metrics(y_true, y_pred):
+    mse = mean_squared_error(y_true, y_pred)
+    return {'mse': mse, 'rmse': np.sqrt(mse), 'mae': mean_absolute_error(y_true, y_pred), 'r2': r2_score(y_true, y_pred)}
+
+def _rows(x, indices):
+    return x.iloc[indices] if hasattr(x, 'iloc') else x[indices]
+
+# Cross-validation run once, folds fitted in parallel; the fold models are kept to score their own test fold,
+# so per-fold metrics and out-of-fold predictions come from the same fits
+def cross_validate_model(model, x, y, cv=5, n_jobs=-1):
+    y = np.asarray(y, dtype=float)
+    fitted = cross_validate(model, x, y, cv=cv, n_jobs=n_jobs, return_estimator=True, return_indices=True)
+    oof_predictions = np.full(len(y), np.nan)
+    folds = []
+    for estimator, test_indices in zip(fitted['estimator'], fitted['indices']['test']):
+        fold_predictions = estimator.predict(_rows(x, test_indices))
+        oof_predictions[test_indices] = fold_predictions
+        folds.append(dict(regression_metrics(y[test_indices], fold_predictions), fit_time=fitted['fit_time'][len(folds)]))
+    return {
+        'folds': pd.DataFrame(folds),
+        'oof_predictions': oof_predictions,
+        'oof': regression_metrics(y, oof_predictions),
+    }
+
+def print_results(title, test_metrics, cv_results):
+    print(f"------ {title} ------")
+    print(f"Mean Squared Error: {test_metrics['mse']}")
+    print(f"R-squared: {test_metrics['r2']}")
+    print(f"Mean Absolute Error: {test_metrics['mae']}")
+    print(f"Root Mean Squared Error: {test_metrics['rmse']}")
+    print(f"Cross-Validated R-squared Scores: {cv_results['folds']['r2'].to_numpy()}")
+    print(f"Mean R-squared: {cv_results['folds']['r2'].mean()}")
+
+def write_results(results_file_path, title, test_metrics, cv_results):#the *-results.txt reports, written from the single CV run
+    folds = cv_results['folds']
+    with open(results_file_path, "w") as results_file:
+        results_file.write(f"------ {title} ------\n")
+        results_file.write(f"Mean Squared Error: {test_metrics['mse']:.4f}\n")
+        results_file.write(f"R-squared: {test_metrics['r2']:.4f}\n")
+        results_file.write(f"Mean Absolute Error: {test_metrics['mae']:.4f}\n")
+        results_file.write(f"Root Mean Squared Error: {test_metrics['rmse']:.4f}\n")
+        results_file.write("\nCross-Validation Results:\n")
+        results_file.write(f"Cross-Validated R-squared Scores: {', '.join(f'{score:.4f}' for score in folds['r2'])}\n")
+        results_file.write(f"Mean R-squared: {folds['r2'].mean():.4f}\n")
+        results_file.write("\nPer-fold metrics:\n")
+        results_file.write(folds.rename(columns=str.upper).to_string(float_format=lambda value: f"{value:.4f}") + "\n")
+        results_file.write("\nOut-of-fold predictions:\n")
+        for name, value in cv_results['oof'].items():
+            results_file.write(f"{name.upper()}: {value:.4f}\n")
+    print(f"Results saved to {results_file_path}")
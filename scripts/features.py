@@ -0,0 +1,196 @@
+from itertools import combinations
+
+import joblib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin
+
+FEATURE_COLUMNS = ['Activities.ActivityCategory', 'Activities.doubleStaffing', 'gender', 'ageSpan', 'SpanDistanceM', 'SpanCarStartTime']
+CATEGORICAL_FEATURES = ['Activities.doubleStaffing', 'gender', 'ageSpan', 'SpanDistanceM', 'SpanCarStartTime']
+ACTIVITY_FEATURE = 'Activities.ActivityCategory'
+TARGET = 'DurationMin'
+
+def observed_categories(column):#levels in the order pd.get_dummies would use them, unused categorical levels left out
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return list(column.cat.remove_unused_categories().cat.categories)
+    return list(pd.Categorical(column.dropna()).categories)
+
+def report_missing(features, target):
+    if pd.DataFrame(features).isnull().any().any():
+        print("Features contain NaN")
+    if target.isnull().any():
+        print("Target contains NaN")
+
+# Fit once on the training frame, then reuse (and joblib-load) for every transform so training and inference can't diverge
+class VisitFeatureEncoder(BaseEstimator, TransformerMixin):
+    def __init__(self, categorical_features=CATEGORICAL_FEATURES, numeric_features=(), target_encode_activity=False, drop_first=True, sparse_output=False):
+        self.categorical_features = categorical_features
+        self.numeric_features = numeric_features
+        self.target_encode_activity = target_encode_activity
+        self.drop_first = drop_first
+        self.sparse_output = sparse_output
+
+    def fit(self, X, y=None):
+        if self.target_encode_activity:
+            if y is None:
+                raise ValueError("target_encode_activity needs the target (DurationMin) to fit")
+            target = pd.Series(np.asarray(y, dtype=float), index=X.index)
+            self.activity_means_ = target.groupby(X[ACTIVITY_FEATURE], observed=True).mean()#Activities.ActivityCategory -> mean duration
+            self.target_mean_ = target.mean()#unseen activities at inference time
+        self.numeric_means_ = np.array([X[column].astype(float).mean() for column in self.numeric_features], dtype=float)
+        numeric_std = np.array([X[column].astype(float).std(ddof=0) for column in self.numeric_features], dtype=float)#StandardScaler semantics
+        self.numeric_scales_ = np.where(numeric_std > 0, numeric_std, 1.0)
+
+        self.categories_ = {}
+        self.one_hot_groups_ = []#source feature of each one-hot column, lets interactions skip mutually exclusive dummies
+        one_hot_names = []
+        for group, column in enumerate(self.categorical_features):
+            levels = observed_categories(X[column])
+            self.categories_[column] = levels
+            kept = levels[1:] if self.drop_first else levels#drop first redundant column of dummy variables
+            one_hot_names += [f"{column}_{level}" for level in kept]
+            self.one_hot_groups_ += [group] * len(kept)
+        dense_names = ([ACTIVITY_FEATURE] if self.target_encode_activity else []) + list(self.numeric_features)
+        self.num_dense_ = len(dense_names)
+        self.feature_names_out_ = np.array(dense_names + one_hot_names, dtype=object)
+        return self
+
+    def get_feature_names_out(self, input_features=None):
+        return self.feature_names_out_
+
+    def _dense_block(self, X):
+        columns = []
+        if self.target_encode_activity:
+            columns.append(X[ACTIVITY_FEATURE].map(self.activity_means_).astype(float).fillna(self.target_mean_).to_numpy())
+        for i, column in enumerate(self.numeric_features):
+            columns.append((X[column].astype(float).to_numpy() - self.numeric_means_[i]) / self.numeric_scales_[i])
+        return np.column_stack(columns).astype(np.float32) if columns else np.empty((len(X), 0), dtype=np.float32)
+
+    def _one_hot_block(self, X):#CSR indicator matrix, unknown or missing levels give an all-zero row like get_dummies
+        rows, cols = [], []
+        offset = 0
+        for column in self.categorical_features:
+            levels = self.categories_[column]
+            codes = pd.Categorical(X[column], categories=levels).codes.astype(np.int64)
+            if self.drop_first:
+                codes -= 1
+            present = np.flatnonzero(codes >= 0)
+            rows.append(present)
+            cols.append(codes[present] + offset)
+            offset += len(levels) - 1 if self.drop_first else len(levels)
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)), shape=(len(X), offset))
+
+    def transform(self, X):
+        dense = self._dense_block(X)
+        one_hot = self._one_hot_block(X)
+        if self.sparse_output:
+            return sparse.hstack([sparse.csr_matrix(dense), one_hot.astype(np.float32)], format='csr')
+        frame = pd.DataFrame(one_hot.toarray(), columns=self.feature_names_out_[self.num_dense_:], index=X.index)#uint8 one-hots
+        for i, name in enumerate(self.feature_names_out_[:self.num_dense_]):
+            frame.insert(i, name, dense[:, i])
+        return frame
+
+    def _record_lookup(self):#(column, level) -> output column, built once so single records skip pandas entirely
+        if getattr(self, 'record_lookup_', None) is None:
+            lookup = {}
+            offset = self.num_dense_
+            for column in self.categorical_features:
+                levels = self.categories_[column][1:] if self.drop_first else self.categories_[column]
+                for i, level in enumerate(levels):
+                    lookup[(column, level.item() if isinstance(level, np.generic) else level)] = offset + i
+                offset += len(levels)
+            self.record_lookup_ = lookup
+        return self.record_lookup_
+
+    def transform_records(self, records):#list of dicts -> float32 matrix, same columns as transform
+        lookup = self._record_lookup()
+        out = np.zeros((len(records), len(self.feature_names_out_)), dtype=np.float32)
+        for row, record in enumerate(records):
+            dense = 0
+            if self.target_encode_activity:
+                out[row, 0] = self.activity_means_.get(record.get(ACTIVITY_FEATURE), self.target_mean_)
+                dense = 1
+            for i, column in enumerate(self.numeric_features):
+                out[row, dense + i] = (float(record[column]) - self.numeric_means_[i]) / self.numeric_scales_[i]
+            for column in self.categorical_features:
+                position = lookup.get((column, record.get(column)))
+                if position is not None:#unknown or dropped level stays all zero
+                    out[row, position] = 1
+        return out
+
+    def save(self, path):
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path):
+        return joblib.load(path)
+
+# Polynomial terms for one-hot input without the dense blow-up: only products of columns from different source features
+# (two levels of the same feature are never both 1), and only interactions seen at least min_count times when fitting
+class GroupedPolynomialFeatures(BaseEstimator, TransformerMixin):
+    def __init__(self, groups, degree=2, min_count=1):
+        self.groups = groups#source feature of each input column, e.g. VisitFeatureEncoder.one_hot_groups_
+        self.degree = degree
+        self.min_count = min_count
+
+    def _active_columns(self, X):#rows x groups matrix of the single non-zero column per group (-1 if none) and its value
+        X = sparse.csr_matrix(X)
+        groups = np.asarray(self.groups)
+        rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        row_groups = groups[X.indices]
+        if len(np.unique(rows * self.num_groups_ + row_groups)) != len(rows):
+            raise ValueError("GroupedPolynomialFeatures expects at most one non-zero column per group in each row")
+        active = np.full((X.shape[0], self.num_groups_), -1, dtype=np.int64)
+        values = np.zeros((X.shape[0], self.num_groups_), dtype=np.float32)
+        active[rows, row_groups] = X.indices
+        values[rows, row_groups] = X.data
+        return X, active, values
+
+    def _term_keys(self, active, combination):#one int64 per row identifying the product of the chosen groups' active columns
+        rows = np.flatnonzero((active[:, combination] >= 0).all(axis=1))
+        keys = np.zeros(len(rows), dtype=np.int64)
+        for group in combination:
+            keys = keys * self.num_features_ + active[rows, group]
+        return rows, keys
+
+    def fit(self, X, y=None):
+        self.num_features_ = X.shape[1]
+        self.num_groups_ = int(np.max(self.groups)) + 1 if len(self.groups) else 0
+        if self.num_features_ ** self.degree >= np.iinfo(np.int64).max:
+            raise ValueError("Too many input columns for this degree")
+        _, active, _ = self._active_columns(X)
+        self.terms_ = []#(group combination, sorted term keys) per block of output columns
+        for degree in range(2, self.degree + 1):
+            for combination in combinations(range(self.num_groups_), degree):
+                _, keys = self._term_keys(active, list(combination))
+                terms, counts = np.unique(keys, return_counts=True)
+                terms = terms[counts >= self.min_count]
+                if len(terms):
+                    self.terms_.append((list(combination), terms))
+        self.num_output_features_ = self.num_features_ + sum(len(terms) for _, terms in self.terms_)
+        return self
+
+    def transform(self, X):
+        X, active, values = self._active_columns(X)
+        blocks = [X.astype(np.float32)]#degree 1 terms, squares of indicators are the indicators themselves
+        for combination, terms in self.terms_:
+            rows, keys = self._term_keys(active, combination)
+            positions = np.minimum(np.searchsorted(terms, keys), len(terms) - 1)
+            known = terms[positions] == keys#interactions not seen when fitting are dropped
+            data = np.prod(values[rows[known]][:, combination], axis=1)
+            blocks.append(sparse.csr_matrix((data, (rows[known], positions[known])), shape=(X.shape[0], len(terms)), dtype=np.float32))
+        return sparse.hstack(blocks, format='csr')
+
+    def get_feature_names_out(self, input_features):
+        names = list(input_features)
+        for combination, terms in self.terms_:
+            for key in terms:
+                columns = []
+                for _ in combination:
+                    key, column = divmod(int(key), self.num_features_)
+                    columns.append(names[column])
+                names.append(" ".join(reversed(columns)))
+        return np.array(names, dtype=object)
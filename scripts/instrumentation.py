@@ -0,0 +1,105 @@
+import cProfile
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+TOP_ALLOCATIONS = 10 # allocation sites kept per stage when tracing memory
+TOP_FUNCTIONS = 15 # cumulative-time rows kept per stage when profiling
+
+# Stage timings and hot-path counters for one run, off by default so an uninstrumented run pays one attribute check per call
+class PipelineMetrics:
+    def __init__(self, enabled=False, profile=False, trace_memory=False, profile_dir=None):
+        self.configure(enabled, profile, trace_memory, profile_dir)
+
+    def configure(self, enabled=True, profile=False, trace_memory=False, profile_dir=None):#also clears whatever was recorded before
+        self.enabled = enabled
+        self.profile = enabled and profile
+        self.trace_memory = enabled and trace_memory
+        self.profile_dir = profile_dir
+        self.started = datetime.now()
+        self.stages = {}
+        self.counters = Counter()
+        self.daily = defaultdict(Counter)
+        self.current_day = None
+        self.depth = 0
+
+    @contextmanager
+    def stage(self, name):#nested stages are timed too, cProfile and tracemalloc only wrap the outermost one
+        if not self.enabled:
+            yield
+            return
+        outermost = self.depth == 0
+        profiler = cProfile.Profile() if self.profile and outermost else None
+        tracing = self.trace_memory and outermost
+        if tracing:
+            tracemalloc.start()
+        if profiler is not None:
+            profiler.enable()
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            self.depth -= 1
+            entry = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0.0})
+            entry['calls'] += 1
+            entry['wall_s'] += wall
+            if profiler is not None:
+                profiler.disable()
+                entry['profile'] = self._profile_summary(name, profiler)
+            if tracing:
+                snapshot = tracemalloc.take_snapshot()
+                entry['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+                entry['top_allocations'] = [{'where': str(stat.traceback), 'size_kb': stat.size / 1024, 'count': stat.count} for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+
+    @contextmanager
+    def on_day(self, day):#counts made inside are also kept under this calendar day
+        self.current_day = str(day)
+        try:
+            yield
+        finally:
+            self.current_day = None
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] += int(n)
+        if self.current_day is not None:
+            self.daily[self.current_day][name] += int(n)
+
+    def _profile_summary(self, name, profiler):
+        stats = pstats.Stats(profiler)
+        if self.profile_dir:#full dump for snakeviz / pstats
+            os.makedirs(self.profile_dir, exist_ok=True)
+            stats.dump_stats(os.path.join(self.profile_dir, f"{name}-{self.started:%Y%m%d-%H%M%S}.prof"))
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+        return [{'function': f"{path}:{line}({function})", 'calls': calls, 'own_s': own, 'cumulative_s': cumulative} for (path, line, function), (_, calls, own, cumulative, _) in rows]
+
+    def report(self):
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'stages': self.stages,
+            'counters': dict(self.counters),
+            'daily': {day: dict(counters) for day, counters in sorted(self.daily.items())},
+        }
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2, default=str)
+        print(f"Metrics report written to {path}")
+
+    def summary(self):#one line per stage, slowest first
+        for name, entry in sorted(self.stages.items(), key=lambda item: item[1]['wall_s'], reverse=True):
+            print(f"{name}: {entry['wall_s']:.3f} s over {entry['calls']} call(s)")
+        for name, value in sorted(self.counters.items()):
+            print(f"{name}: {value}")
+
+METRICS = PipelineMetrics() # shared by every module of a run, preprocess_data.py turns it on from config.yaml
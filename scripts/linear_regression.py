@@ -1,14 +1,18 @@
-import pandas as pd
-from sklearn.model_selection import train_test_split, cross_val_score
+from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LinearRegression
 from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import mean_squared_error, r2_score
 import matplotlib.pyplot as plt
 import seaborn as sns
 import os
+import time
 
-file_path = "/Users/tomas/Documents/GitHub/ITHS-AI-Project/data/df.xlsx"
-df = pd.read_excel(file_path)
+from config_loader import ConfigLoader
+from dataset import MODEL_COLUMNS, file_version, load_processed_data
+from evaluation import cross_validate_model, print_results, regression_metrics, write_results
+from features import TARGET, VisitFeatureEncoder, report_missing
+from model_registry import register_model, reusable_model
+
+df = load_processed_data(columns=MODEL_COLUMNS)
 df = df[df['Information'] == 'match']
 
 # Determine OS
@@ -20,20 +24,15 @@ df = df[df['Information'] == 'match']
 #     else:  # Assume Linux for other systems
 #         return config['file_paths']['linux']
 
-# Define features
-df_features = df[['Activities.ActivityCategory', 'Activities.doubleStaffing', 'gender', 
-               'ageSpan', 'SpanDistanceM', 'SpanCarStartTime']]
-
-# Activities.ActivityCategory encoding
-activity_category_means = df.groupby('Activities.ActivityCategory')['DurationMin'].mean()
-df_features['Activities.ActivityCategory'] = df_features['Activities.ActivityCategory'].map(activity_category_means)
-df_features = df_features.drop(columns=['Activities.ActivityCategory'])
+# Reuse the registered model if it was trained on this data
+data_version = file_version(ConfigLoader().get_processed_file_path())
+registered = reusable_model('LinearRegression', data_version, {})
 
-# One-hot encoding 
-categorical_features = ['Activities.doubleStaffing', 'gender', 'ageSpan', 'SpanDistanceM', 'SpanCarStartTime']
-df_features = pd.get_dummies(df_features, columns=categorical_features, drop_first=True)
+# One-hot encoding, shared fitted encoder registered with the model
+encoder = registered.encoder if registered else VisitFeatureEncoder().fit(df, df[TARGET])
+df_features = encoder.transform(df)
 
-target = df['DurationMin']
+target = df[TARGET]
 
 ## Visualise features
 # sns.boxplot(data=df[['Activities.ActivityCategory', 'Activities.doubleStaffing', 'gender', 
@@ -47,11 +46,7 @@ target = df['DurationMin']
 # plt.ylabel('DurationMin')
 # plt.show()
 
-if df_features.isnull().any().any():
-    print("Features contain NaN")
-
-if target.isnull().any():
-    print("Target contains NaN")
+report_missing(df_features, target)
 
 # # # Scale
 # scaler = StandardScaler()
@@ -61,22 +56,22 @@ if target.isnull().any():
 #  test sets
 x_train, x_test, y_train, y_test = train_test_split(df_features, target, test_size=0.2, random_state=42)
 
-# Fit LinearRegression
-model = LinearRegression()
-model.fit(x_train, y_train)
+# Fit LinearRegression, crossvalidation runs once with folds in parallel
+if registered:
+    model = registered.model
+    cv_results = registered.cv_results()
+else:
+    start = time.perf_counter()
+    model = LinearRegression()
+    model.fit(x_train, y_train)
+    fit_time = time.perf_counter() - start
+    cv_results = cross_validate_model(LinearRegression(), x_train, y_train, cv=5)
 
 # Evaluate model
-y_pred = model.predict(x_test)
-mse = mean_squared_error(y_test, y_pred)
-r2 = r2_score(y_test, y_pred)
-print("------ Linear regression ------")
-print(f"Mean Squared Error: {mse}")
-print(f"R-squared: {r2}")
-
-# Crossvalidation
-cv_scores = cross_val_score(model, x_train, y_train, cv=5, scoring='r2')
-print(f"Cross-Validated R-squared Scores: {cv_scores}")
-print(f"Mean R-squared: {cv_scores.mean()}")
+test_metrics = regression_metrics(y_test, model.predict(x_test))
+print_results("Linear regression", test_metrics, cv_results)
+if not registered:
+    register_model('LinearRegression', model, encoder, data_version, {}, test_metrics, cv_results, fit_time, x_train.shape[0])
 
 # coefficients = pd.DataFrame({
 #     "Feature": df.columns,
@@ -85,15 +80,5 @@ print(f"Mean R-squared: {cv_scores.mean()}")
 # print(coefficients)
 
 # Output LinearRegression-results.txt
-output_file_path = ('/Users/tomas/Documents/GitHub/ITHS-AI-Project/data/df.xlsx')
-
-results_file_path = os.path.join(os.path.dirname(output_file_path), "LinearRegression-results.txt")
-
-with open(results_file_path, "w") as results_file:
-    results_file.write("------ Linear Regression Results ------\n")
-    results_file.write(f"Mean Squared Error: {mse:.4f}\n")
-    results_file.write(f"R-squared: {r2:.4f}\n")
-    results_file.write("\nCross-Validation Results:\n")
-    results_file.write(f"Cross-Validated R-squared Scores: {', '.join(f'{score:.4f}' for score in cv_scores)}\n")
-    results_file.write(f"Mean R-squared: {cv_scores.mean():.4f}\n")
-print(f"Linear regression results saved to {results_file_path}")
+results_file_path = os.path.join(ConfigLoader().get_data_dir(), "LinearRegression-results.txt")
+write_results(results_file_path, "Linear Regression Results", test_metrics, cv_results)
@@ -0,0 +1,105 @@
+import os
+from datetime import datetime
+
+import joblib
+import numpy as np
+import pandas as pd
+import yaml
+
+from config_loader import MODELS_DIR, ConfigLoader
+from features import VisitFeatureEncoder
+
+REGISTRY_PATH = os.path.join(MODELS_DIR, 'models.yaml')
+REGISTRY_HEADER = ("# Trained models, written by scripts/model_registry.py (the .joblib files themselves are not in git)\n"
+                   "# Models are loaded lazily but fully into memory: sklearn copies a forest's tree arrays when unpickling, so mmap_mode would not save anything\n")
+
+def read_registry(registry_path=REGISTRY_PATH):
+    if not os.path.exists(registry_path):
+        return {}
+    with open(registry_path, 'r') as file:
+        return yaml.safe_load(file) or {}
+
+def write_registry(entries, registry_path=REGISTRY_PATH):
+    with open(registry_path, 'w') as file:
+        file.write(REGISTRY_HEADER)
+        yaml.safe_dump(entries, file, sort_keys=False)
+
+def _plain(value):#numpy scalars/arrays -> python values yaml can write
+    if isinstance(value, dict):
+        return {str(key): _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+# A models.yaml entry; the estimator and encoder are only read from disk on first use (then held in memory, trees can't stay memory-mapped)
+class RegisteredModel:
+    def __init__(self, name, entry, models_dir=MODELS_DIR):
+        self.name = name
+        self.entry = entry
+        self.models_dir = models_dir
+        self._model = None
+        self._encoder = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = joblib.load(os.path.join(self.models_dir, self.entry['model_file']))
+        return self._model
+
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            self._encoder = VisitFeatureEncoder.load(os.path.join(self.models_dir, self.entry['encoder_file']))
+        return self._encoder
+
+    def matches(self, data_version, params):#trained on the same processed data with the same hyperparameters
+        return self.entry.get('data_version') == data_version and self.entry.get('params') == _plain(params)
+
+    def cv_results(self):#the stored cross-validation summary, in the shape evaluation.print_results/write_results read
+        return {'folds': pd.DataFrame(self.entry['cv_folds']), 'oof': self.entry['cv_oof']}
+
+def get_model(name, registry_path=REGISTRY_PATH):#None when the model was never registered or its files are gone
+    entry = read_registry(registry_path).get(name)
+    models_dir = os.path.dirname(os.path.abspath(registry_path))
+    if entry is None or not all(os.path.exists(os.path.join(models_dir, entry[key])) for key in ('model_file', 'encoder_file')):
+        return None
+    return RegisteredModel(name, entry, models_dir)
+
+def reusable_model(name, data_version, params, registry_path=REGISTRY_PATH):#registered model for this data and params, unless model_registry.reuse is off
+    if not ConfigLoader().config.get('model_registry', {}).get('reuse', True):
+        return None
+    registered = get_model(name, registry_path)
+    if registered is None or not registered.matches(data_version, params):
+        return None
+    print(f"Reusing {name} from {registry_path} (trained {registered.entry['trained_at']}, fit took {registered.entry['fit_time_s']:.2f} s)")
+    return registered
+
+def register_model(name, model, encoder, data_version, params, test_metrics, cv_results, fit_time_s, n_train, registry_path=REGISTRY_PATH):
+    models_dir = os.path.dirname(os.path.abspath(registry_path))
+    os.makedirs(models_dir, exist_ok=True)
+    model_file = f"{name}.joblib"
+    encoder_file = f"{name}-features.joblib"
+    joblib.dump(model, os.path.join(models_dir, model_file))#uncompressed, loads faster
+    encoder.save(os.path.join(models_dir, encoder_file))
+
+    entries = read_registry(registry_path)
+    entries[name] = _plain({
+        'estimator': f"{type(model).__module__}.{type(model).__name__}",
+        'model_file': model_file,
+        'encoder_file': encoder_file,
+        'params': params,
+        'data_version': data_version,
+        'n_train': n_train,
+        'trained_at': datetime.now().isoformat(timespec='seconds'),
+        'fit_time_s': fit_time_s,
+        'test_metrics': test_metrics,
+        'cv_folds': cv_results['folds'].to_dict(orient='records'),
+        'cv_oof': cv_results['oof'],
+    })
+    write_registry(entries, registry_path)
+    print(f"{name} registered in {registry_path}")
+    return RegisteredModel(name, entries[name], models_dir)
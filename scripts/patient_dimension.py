@@ -0,0 +1,64 @@
+import os
+
+import pandas as pd
+
+VISIT_KEY = 'CareEpisodeID'
+LOCATION_KEY = 'id'
+DEMOGRAPHICS_KEY = 'careEpisodeID'
+ROW_HASH = '_row_hash' # per-patient content hash kept next to the attributes to spot changed rows
+
+def _indexed(frame, key):#one row per patient (the sheet's last one wins), indexed by the key, with its content hash
+    table = frame.drop_duplicates(subset=key, keep='last').set_index(key, drop=False)
+    table.index.name = None
+    table[ROW_HASH] = pd.util.hash_pandas_object(table, index=False).to_numpy()
+    return table
+
+def _changes(stored, current):#added/changed/removed patients between the stored table and the sheet
+    if stored is None:
+        return {'added': len(current), 'changed': 0, 'removed': 0}
+    common = current.index.intersection(stored.index)
+    changed = (stored.loc[common, ROW_HASH].to_numpy() != current.loc[common, ROW_HASH].to_numpy()).sum()
+    return {'added': len(current.index.difference(stored.index)), 'changed': int(changed), 'removed': len(stored.index.difference(current.index))}
+
+# Per-patient location and demographics tables keyed by care episode, kept as Parquet in data/cache/patients/
+# so visits are enriched by index lookups instead of two merges, and the tables are only rewritten when patients change
+class PatientDimension:
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.locations = None
+        self.demographics = None
+        if directory and all(os.path.exists(path) for path in self._paths()):
+            self.locations, self.demographics = (pd.read_parquet(path) for path in self._paths())
+
+    def _paths(self):
+        return [os.path.join(self.directory, 'locations.parquet'), os.path.join(self.directory, 'demographics.parquet')]
+
+    def update(self, patient_location, patient_demographics):#sync with the current sheets, returns the change counts per table
+        changes = {}
+        for name, frame, key in [('locations', patient_location, LOCATION_KEY), ('demographics', patient_demographics, DEMOGRAPHICS_KEY)]:
+            stored = getattr(self, name)
+            current = _indexed(frame, key)
+            if stored is not None and list(stored.columns) != list(current.columns):#sheet layout changed, start over
+                stored = None
+            changes[name] = _changes(stored, current)
+            if stored is None or any(changes[name].values()):
+                setattr(self, name, current)
+            else:
+                setattr(self, name, stored)#unchanged, keep the stored table and skip the write
+        if self.directory and any(any(counts.values()) for counts in changes.values()):
+            os.makedirs(self.directory, exist_ok=True)
+            for table, path in zip([self.locations, self.demographics], self._paths()):
+                table.to_parquet(path)
+        return changes
+
+    def enrich(self, visits):#same rows and columns as pd.merge with pLocation (inner) then demographics (left)
+        positions = self.locations.index.get_indexer(visits[VISIT_KEY])
+        matched = positions >= 0
+        visits = visits[matched].reset_index(drop=True)
+        locations = self.locations.iloc[positions[matched]].drop(columns=ROW_HASH).reset_index(drop=True)
+        demographics = self.demographics.reindex(visits[VISIT_KEY].to_numpy()).drop(columns=ROW_HASH).reset_index(drop=True)
+        return pd.concat([visits, locations, demographics], axis=1)
+
+    def can_enrich(self, visits):#merges would add _x/_y suffixes on shared column names, those are left to pd.merge
+        names = [list(visits.columns), [c for c in self.locations.columns if c != ROW_HASH], [c for c in self.demographics.columns if c != ROW_HASH]]
+        return len(set().union(*names)) == sum(len(columns) for columns in names)
@@ -1,30 +1,35 @@
-import pandas as pd
-from sklearn.model_selection import train_test_split, cross_val_score
+from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import OrdinalEncoder, PolynomialFeatures, StandardScaler
 from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.pipeline import Pipeline
 import matplotlib.pyplot as plt
 import seaborn as sns
 import os
+import time
+
+from config_loader import ConfigLoader
+from dataset import MODEL_COLUMNS, file_version, load_processed_data
+from evaluation import cross_validate_model, print_results, regression_metrics, write_results
+from features import TARGET, GroupedPolynomialFeatures, VisitFeatureEncoder
+from model_registry import register_model, reusable_model
+
+polynomial_config = ConfigLoader().config.get('polynomial_regression', {})
+POLY_MODE = polynomial_config.get('mode', 'sparse') # 'sparse' skips same-feature dummy products, 'dense' is plain PolynomialFeatures
+POLY_DEGREE = polynomial_config.get('degree', 2)
 
 # Load filter dataset
-file_path = "/Users/tomas/Documents/GitHub/AImed/data/df.xlsx"
-df = pd.read_excel(file_path)
+df = load_processed_data(columns=MODEL_COLUMNS)
 df = df[df['Information'] == 'match']
 
-# Define features
-df_features = df[['Activities.ActivityCategory', 'Activities.doubleStaffing', 'gender', 
-                  'ageSpan', 'SpanDistanceM', 'SpanCarStartTime']]
-target = df['DurationMin']
-
-# Target encoding Activities.ActivityCategory
-activity_category_means = df.groupby('Activities.ActivityCategory')['DurationMin'].mean()
-df_features['Activities.ActivityCategory'] = df_features['Activities.ActivityCategory'].map(activity_category_means)
-df_features = df_features.drop(columns=['Activities.ActivityCategory'])
+# Reuse the registered model if it was trained on this data with the same polynomial settings
+params = {'mode': POLY_MODE, 'degree': POLY_DEGREE, 'min_count': polynomial_config.get('min_count', 1)}
+data_version = file_version(ConfigLoader().get_processed_file_path())
+registered = reusable_model('PolynomialRegression', data_version, params)
 
-# One-hot
-categorical_features = ['Activities.doubleStaffing', 'gender', 'ageSpan', 'SpanDistanceM', 'SpanCarStartTime']
-df_features = pd.get_dummies(df_features, columns=categorical_features, drop_first=True)
+# One-hot, shared fitted encoder
+target = df[TARGET]
+encoder = registered.encoder if registered else VisitFeatureEncoder(sparse_output=(POLY_MODE == 'sparse')).fit(df, target)
+df_features = encoder.transform(df)
 
 # # Check for NaN
 # if df_features.isnull().any().any():
@@ -38,41 +43,38 @@ df_features = pd.get_dummies(df_features, columns=categorical_features, drop_fir
 # features_scaled = scaler.fit_transform(features)
 
 # polynomial 
-poly = PolynomialFeatures(degree=2, include_bias=False)  # You can adjust the degree here
-features_poly = poly.fit_transform(df_features)
+if registered:#the registered pipeline holds the fitted polynomial step
+    poly = registered.model.named_steps['poly']
+    features_poly = poly.transform(df_features)
+else:
+    if POLY_MODE == 'sparse':
+        poly = GroupedPolynomialFeatures(encoder.one_hot_groups_, degree=POLY_DEGREE, min_count=params['min_count'])
+    else:
+        poly = PolynomialFeatures(degree=POLY_DEGREE, include_bias=False)
+    features_poly = poly.fit_transform(df_features)
+print(f"Polynomial features ({POLY_MODE}, degree {POLY_DEGREE}): {features_poly.shape[1]}")
 
 # Split train 
 #  test sets
 x_train, x_test, y_train, y_test = train_test_split(features_poly, target, test_size=0.2, random_state=42)
 
-# Fit polynomial regression
-model = LinearRegression()
-model.fit(x_train, y_train)
+# Fit polynomial regression, cross-validation once with folds in parallel
+if registered:
+    model = registered.model.named_steps['regression']
+    cv_results = registered.cv_results()
+else:
+    start = time.perf_counter()
+    model = LinearRegression()
+    model.fit(x_train, y_train)
+    fit_time = time.perf_counter() - start
+    cv_results = cross_validate_model(LinearRegression(), x_train, y_train, cv=5)
 
 # Evaluate
-y_pred = model.predict(x_test)
-mse = mean_squared_error(y_test, y_pred)
-r2 = r2_score(y_test, y_pred)
-print("------ Polynomial regression ------")
-print(f"Mean Squared Error: {mse}")
-print(f"R-squared: {r2}")
-
-# Cross-validation
-cv_scores = cross_val_score(model, x_train, y_train, cv=5, scoring='r2')
-print(f"Cross-Validated R-squared Scores: {cv_scores}")
-print(f"Mean R-squared: {cv_scores.mean()}")
+test_metrics = regression_metrics(y_test, model.predict(x_test))
+print_results("Polynomial regression", test_metrics, cv_results)
+if not registered:#registered as one pipeline, so it predicts straight from the encoder output
+    register_model('PolynomialRegression', Pipeline([('poly', poly), ('regression', model)]), encoder, data_version, params, test_metrics, cv_results, fit_time, x_train.shape[0])
 
 # Output polynomialRegression-results.txt
-output_file_path = ('/Users/tomas/Documents/GitHub/ITHS-AI-Project/data/polynomialRegression-results.txt')
-
-results_file_path = os.path.join(os.path.dirname(output_file_path), "polynomialRegression-results.txt")
-
-with open(results_file_path, "w") as results_file:
-    results_file.write("------ Polynomial regression ------\n")
-    results_file.write(f"Mean Squared Error: {mse:.4f}\n")
-    results_file.write(f"R-squared: {r2:.4f}\n")
-    results_file.write("\nCross-Validation Results:\n")
-    results_file.write(f"Cross-Validated R-squared Scores: {', '.join(f'{score:.4f}' for score in cv_scores)}\n")
-    results_file.write(f"Mean R-squared: {cv_scores.mean():.4f}\n")
-print(f"polynomialRegression results saved to {results_file_path}")
-print(f"Results saved to {results_file_path}")
\ No newline at end of file
+results_file_path = os.path.join(ConfigLoader().get_data_dir(), "polynomialRegression-results.txt")
+write_results(results_file_path, "Polynomial regression", test_metrics, cv_results)
@@ -0,0 +1,143 @@
+import argparse
+import json
+import sys
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import joblib
+import numpy as np
+
+from features import VisitFeatureEncoder
+from model_registry import REGISTRY_PATH, get_model
+
+PREDICTION_CACHE_SIZE = 100000 # distinct encoded visits remembered, the one-hot feature space is small so repeats are the norm
+
+MODEL_NAME = 'RandomForest' # models/models.yaml entry served by default
+# short names accepted next to the processed-data column names
+FIELD_ALIASES = {
+    'activity': 'Activities.ActivityCategory',
+    'double_staffing': 'Activities.doubleStaffing',
+    'age_span': 'ageSpan',
+    'distance_bucket': 'SpanDistanceM',
+    'start_time_bucket': 'SpanCarStartTime',
+}
+
+# the model was fitted on a DataFrame, we feed it plain float32 arrays on purpose
+warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+class DurationPredictor:#model and encoder loaded once, predictions go straight from dicts to a float32 matrix
+    def __init__(self, model, encoder):
+        self.model = model
+        if hasattr(self.model, 'n_jobs'):
+            self.model.n_jobs = 1#a thread pool per call costs more than it saves on a handful of rows
+        self.trees = [estimator.tree_ for estimator in getattr(self.model, 'estimators_', [])]#forest averaged by hand, skips sklearn's per-call validation
+        self.encoder = encoder
+        self.cache = {}
+        self.predict([{}])#warm up the lookup tables and tree code paths before the first real request
+
+    @classmethod
+    def from_registry(cls, name=MODEL_NAME, registry_path=REGISTRY_PATH):
+        registered = get_model(name, registry_path)
+        if registered is None:
+            raise FileNotFoundError(f"No trained '{name}' model in {registry_path}, run its training script first")
+        return cls(registered.model, registered.encoder)
+
+    @classmethod
+    def from_files(cls, model_path, encoder_path):#a model saved outside the registry
+        return cls(joblib.load(model_path), VisitFeatureEncoder.load(encoder_path))
+
+    def _predict_matrix(self, X):
+        if not self.trees:
+            return np.asarray(self.model.predict(X), dtype=float)
+        total = np.zeros(len(X))
+        for tree in self.trees:
+            total += tree.predict(X)[:, 0]#single-output regression trees
+        return total / len(self.trees)
+
+    def predict(self, visits):
+        records = [{FIELD_ALIASES.get(key, key): value for key, value in visit.items()} for visit in visits]
+        X = self.encoder.transform_records(records)
+        keys = [row.tobytes() for row in X]
+        missing = [i for i, key in enumerate(keys) if key not in self.cache]
+        if missing:
+            if len(self.cache) + len(missing) > PREDICTION_CACHE_SIZE:
+                self.cache.clear()
+            for i, prediction in zip(missing, self._predict_matrix(X[missing]).tolist()):
+                self.cache[keys[i]] = prediction
+        return [self.cache[key] for key in keys]
+
+def handle_payload(predictor, payload):#a single visit -> {"prediction": x}, a list or {"visits": [...]} -> {"predictions": [...]}
+    start = time.perf_counter()
+    if isinstance(payload, dict) and 'visits' in payload:
+        payload = payload['visits']
+    visits = payload if isinstance(payload, list) else [payload]
+    for visit in visits:#anything but an object ("x", 5, [1]) is a bad request, not a crash
+        if not isinstance(visit, dict):
+            raise TypeError(f"a visit must be a JSON object, got {type(visit).__name__}: {json.dumps(visit)[:100]}")
+    if isinstance(payload, list):
+        response = {'predictions': predictor.predict(visits)}
+    else:
+        response = {'prediction': predictor.predict(visits)[0]}
+    response['latency_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return response
+
+def serve_stdin(predictor):#one JSON payload per line in, one JSON response per line out
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            response = handle_payload(predictor, json.loads(line))
+        except (ValueError, KeyError, TypeError) as e:
+            response = {'error': str(e)}
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
+
+def serve_http(predictor, host, port):
+    class PredictHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, {'status': 'ok'})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self._send(200, handle_payload(predictor, payload))
+            except (ValueError, KeyError, TypeError) as e:
+                self._send(400, {'error': str(e)})
+
+        def log_message(self, format, *args):#no per-request stderr logging on the hot path
+            pass
+
+    server = HTTPServer((host, port), PredictHandler)
+    print(f"Serving visit-duration predictions on http://{host}:{port}/predict")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Visit-duration predictions from the trained RandomForest")
+    parser.add_argument('--stdin', action='store_true', help="read JSON lines from stdin instead of serving HTTP")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--name', default=MODEL_NAME, help="models/models.yaml entry to serve")
+    parser.add_argument('--model', help="joblib model file instead of a registry entry (needs --encoder)")
+    parser.add_argument('--encoder')
+    args = parser.parse_args()
+
+    predictor = DurationPredictor.from_files(args.model, args.encoder) if args.model else DurationPredictor.from_registry(args.name)
+    if args.stdin:
+        serve_stdin(predictor)
+    else:
+        serve_http(predictor, args.host, args.port)
@@ -1,13 +1,26 @@
 import os
 
 import csv
-import yaml
 import json
+import hashlib
+import pickle
+import shutil
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
+import numpy as np
 import pandas as pd
-#import pickle
+import pyarrow.parquet as pq
 from datetime import datetime, timedelta
 import geopy.distance
+from sklearn.neighbors import BallTree
+
+from config_loader import ConfigLoader
+from dataset import apply_schema, save_processed_data, text_if_mixed
+from instrumentation import METRICS
+from patient_dimension import PatientDimension
 
 CAR_DISTANCE_THRESHOLD = 150 # if car is closer than  this, it's relevant
 CAR_TIME_THRESHOLD_BEFORE = 2 # if car is parked within these limits, it's relevant
@@ -15,36 +28,42 @@ CAR_TIME_THRESHOLD_AFTER = 1
 MIN_DISTANCE_DEFAULT = 1000000  # 
 BUCKETS_FOR_DISTANCE = 6 # num of buckets for distance
 BUCKET_FOR_CAR_START_TIME = 12 # num of  buckets for 'time of day'
+MATCHING_ENGINE = 'vectorized' # 'spatial' (BallTree candidates) / 'legacy' (original row-by-row loop, the reference output)
+SPATIAL_KNN = 16 # neighbours fetched per BallTree query when looking for the nearest non-matching car stop
+
+# WGS-84 ellipsoid, same one geopy.distance.geodesic uses
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+EARTH_RADIUS_M = 6371008.8 # mean radius for the haversine BallTree
+GEODESIC_TOLERANCE = 0.01 # haversine vs ellipsoid differ by < 0.5%, index search radii are widened by this
+CACHED_SHEETS = ['finishedOccurrences', 'finishedVisits', 'carTrips', 'pLocation', 'patientsDemographics'] # in load_data return order
+CACHE_MANIFEST = 'manifest.json'
+CACHE_VERSION = 3 # bump whenever parse_workbook changes what it returns, so sheets cached by an older parser are not served
+DAILY_RESULTS_VERSION = 1 # bump whenever a matcher's output changes, so per-date results of the incremental mode are recomputed
+DISTANCE_CACHE_PRECISION = 6 # decimals coordinates are rounded to for cache keys (~0.1 m), DistanceM can only move by 1 m at a rounding edge
+DISTANCE_CACHE_SIZE = 2000000 # distances kept in the LRU before the oldest are evicted
+DISTANCE_CACHE_SMALL_CALL = 256 # calls measuring up to this many new pairs keep them in a dict instead of re-indexing the cache table
+DISTANCE_CACHE_MERGE_ROWS = 65536 # dict entries that trigger a re-index
+DISTANCE_CACHE_SAMPLE_EVERY = 50 # about one hit in this many is measured anyway, to report the time the cache saved
+MATCHING_VISIT_COLUMNS = ['visitId', 'CareEpisodeID', 'latitude', 'longitude', 'TravelToVisitStarted.StartTime', 'VisitFinished.event_data.finishedAt'] # everything a day's matching reads
+MATCHING_TRIP_COLUMNS = ['id.1', 'location.1.latitude', 'location.1.longitude', 'location.1.timestamp', 'location.timestamp']
+CAR_TRIP_CHUNK_ROWS = 100000 # car trips read per chunk when streaming, also the row-group size of the cached carTrips sheet
+INFO_COUNTERS = {'match': 'matches', 'no match': 'no_matches', 'no car trips this date': 'days_without_car_trips'} # metrics counter per Information value
+# dtypes enforced when the workbook is parsed, so the Parquet cache, merges and groupbys work on compact columns
+# coordinates stay float64: float32 is only ~0.4 m precise at our latitudes and would move DistanceM
+SHEET_SCHEMAS = {
+    'finishedOccurrences': {'Activities.ActivityCategory': 'category', 'Activities.title': 'category', 'Activities.doubleStaffing': 'category'},
+    'finishedVisits': {'CareEpisodeID': 'id', 'TravelToVisitStarted.StartTime': 'datetime', 'VisitFinished.event_data.finishedAt': 'datetime'},
+    'carTrips': {'id': 'id', 'id.1': 'category'},
+    'pLocation': {'id': 'id'},
+    'patientsDemographics': {'careEpisodeID': 'id', 'gender': 'category', 'ageSpan': 'category'},
+}
+DISTANCE_SCHEMA = {'CareEpisodeID': 'id', 'DurationMin': 'float32', 'DistanceM': 'int32', 'SpanDistanceM': 'int8', 'SpanCarStartTime': 'int8', 'Information': pd.CategoricalDtype(list(INFO_COUNTERS))}
 
 # Display all columns
 pd.set_option('display.max_columns', None)
 
-# ConfigLoader Class
-class ConfigLoader:
-    def __init__(self, config_path):
-        self.config_path = config_path
-        self.config = self._load_config()
-
-    def _load_config(self):
-        with open(self.config_path, 'r') as file:
-            return yaml.safe_load(file)
-
-    def get_file_path(self):
-        if os.name == 'nt':  # Windows
-            return self.config['file_paths']['windows']
-        elif os.uname().sysname == 'Darwin':  # macOS
-            return self.config['file_paths']['mac']
-        else:  # Assume Linux
-            return self.config['file_paths']['linux']
-
-    def get_output_file_path(self):
-        if os.name == 'nt':  # Windows
-            return self.config['output_file_path']['windows']
-        elif os.uname().sysname == 'Darwin':  # macOS
-            return self.config['output_file_path']['mac']
-        else:  # Assume Linux 
-            return self.config['output_file_path']['linux']
-
 # # OS
 # def get_file_path(config):
 #     if os.name == 'nt':  # Windows
@@ -54,124 +73,824 @@ class ConfigLoader:
 #     else:  # Assume Linux for other systems
 #         return config['file_paths']['linux']
 
-def add_new_row(distance_df, visit_id, patient_id, car_start_time, car_end_time, duration_min, distance, span_distance, span_car_start_time, info):
-    new_row = pd.DataFrame([{
-        'VisitID': visit_id,
-        'CareEpisodeID': patient_id,
-        'CarStartTime': car_start_time,
-        'CarEndTime': car_end_time,
-        'DurationMin': duration_min,
-        'DistanceM': distance,
-        'SpanDistanceM': span_distance,
-        'SpanCarStartTime': span_car_start_time,
-        'Information': info
-    }])
-
-    if not new_row.empty:
-        distance_df = pd.concat([distance_df, new_row], ignore_index=True)
-    
-    return distance_df
-
-def load_data(file_path):
-    xls = pd.ExcelFile(file_path)
-    finished_occurrences = xls.parse('finishedOccurrences')
-    finished_occurrences['Activities.ActivityCategory'] = finished_occurrences['Activities.ActivityCategory'].fillna(finished_occurrences['Activities.title'])
-    finished_visits = xls.parse('finishedVisits')
-    car_trips = xls.parse('carTrips')
-    car_trips['location.1.timestamp'] = pd.to_datetime(car_trips['location.1.timestamp'])  # Convert to datetime
-    car_trips['location.timestamp'] = pd.to_datetime(car_trips['location.timestamp']) 
-    car_trips=car_trips.sort_values(by='location.timestamp')
-    patient_location = xls.parse('pLocation')
-    patients_demographics = xls.parse('patientsDemographics')
-    demographics_df = pd.json_normalize(patients_demographics['demographics'].apply(json.loads))
+DISTANCE_COLUMNS = ['VisitID', 'CareEpisodeID', 'CarStartTime', 'CarEndTime', 'DurationMin', 'DistanceM', 'SpanDistanceM', 'SpanCarStartTime', 'Information']
+
+class DistanceResults:#columnar accumulator for matched car trips and visits, one DataFrame is built at the end instead of a concat per row
+    def __init__(self):
+        self.visit_ids = []
+        self.patient_ids = []
+        self.car_start_times = []
+        self.car_end_times = []
+        self.duration_min = array('d')
+        self.distance = array('q')
+        self.span_distance = array('q')
+        self.span_car_start_time = array('q')
+        self.info = []
+
+    def __len__(self):
+        return len(self.info)
+
+    def add_row(self, visit_id, patient_id, car_start_time, car_end_time, duration_min, distance, span_distance, span_car_start_time, info):
+        self.visit_ids.append(visit_id)
+        self.patient_ids.append(patient_id)
+        self.car_start_times.append(car_start_time)
+        self.car_end_times.append(car_end_time)
+        self.duration_min.append(duration_min)
+        self.distance.append(distance)
+        self.span_distance.append(span_distance)
+        self.span_car_start_time.append(span_car_start_time)
+        self.info.append(info)
+
+    def to_frame(self):
+        return apply_schema(pd.DataFrame({
+            'VisitID': self.visit_ids,
+            'CareEpisodeID': self.patient_ids,
+            'CarStartTime': pd.to_datetime(self.car_start_times),
+            'CarEndTime': pd.to_datetime(self.car_end_times),
+            'DurationMin': np.frombuffer(self.duration_min, dtype=np.float64).copy(),
+            'DistanceM': np.frombuffer(self.distance, dtype=np.int64).copy(),
+            'SpanDistanceM': np.frombuffer(self.span_distance, dtype=np.int64).copy(),
+            'SpanCarStartTime': np.frombuffer(self.span_car_start_time, dtype=np.int64).copy(),
+            'Information': self.info
+        }, columns=DISTANCE_COLUMNS), DISTANCE_SCHEMA)
+
+def parse_workbook(file_path):#parse and type every sheet of the source workbook
+    with METRICS.stage('parse_excel'):
+        xls = pd.ExcelFile(file_path)
+        finished_occurrences = xls.parse('finishedOccurrences')
+        finished_occurrences['Activities.ActivityCategory'] = finished_occurrences['Activities.ActivityCategory'].fillna(finished_occurrences['Activities.title'])
+        finished_visits = xls.parse('finishedVisits')
+        car_trips = xls.parse('carTrips')
+        car_trips['location.1.timestamp'] = pd.to_datetime(car_trips['location.1.timestamp'])  # Convert to datetime
+        car_trips['location.timestamp'] = pd.to_datetime(car_trips['location.timestamp']) 
+        car_trips=car_trips.sort_values(by='location.timestamp')
+        patient_location = xls.parse('pLocation')
+        patients_demographics = xls.parse('patientsDemographics')
+    with METRICS.stage('demographics_json'):#each distinct JSON string is parsed once, patients share a handful of gender/ageSpan combinations
+        codes, unique_json = pd.factorize(patients_demographics['demographics'], use_na_sentinel=False)
+        demographics_df = pd.json_normalize([json.loads(text) for text in unique_json]).iloc[codes].reset_index(drop=True)
     patients_demographics = patients_demographics.drop(columns=['demographics'])
     patient_demographics = pd.concat([patients_demographics, demographics_df], axis=1)
-    return finished_occurrences, finished_visits, car_trips, patient_location, patient_demographics
+    frames = finished_occurrences, finished_visits, car_trips, patient_location, patient_demographics
+    frames = [frame.apply(text_if_mixed) for frame in frames]#object columns mixing numbers and text become text, so every sheet can be cached as Parquet
+    return tuple(apply_schema(frame, SHEET_SCHEMAS[sheet]) for sheet, frame in zip(CACHED_SHEETS, frames))
+
+def source_fingerprint(file_path, cache_dir):#content hash of the workbook, only re-hashed when mtime/size change
+    stat = os.stat(file_path)
+    source = os.path.abspath(file_path)
+    manifest_path = os.path.join(cache_dir, CACHE_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+
+    entry = manifest.get(source)
+    if entry and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+        return entry['sha256']
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    sha256 = digest.hexdigest()
+    if entry and entry['sha256'] != sha256:#workbook changed, the old parsed sheets are stale
+        remove_sheet_dirs(cache_dir, entry['sha256'])
+
+    manifest[source] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha256}
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(manifest_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    return sha256
 
-def preprocess_data(finished_visits, patient_location, patient_demographics):
-    df = pd.merge(finished_visits, patient_location, how='inner', left_on='CareEpisodeID', right_on='id')
-    df = pd.merge(df, patient_demographics, how='left', left_on='CareEpisodeID', right_on='careEpisodeID')
-    df['date'] = df['TravelToVisitStarted.StartTime'].dt.date
+def cache_format():#parser version, sheet schemas and row-group size: changing any of them re-parses the workbook
+    text = json.dumps([CACHE_VERSION, SHEET_SCHEMAS, CAR_TRIP_CHUNK_ROWS], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:8]
+
+def remove_sheet_dirs(cache_dir, sha256, keep=None):#parsed sheets of one workbook version, in any cache format but keep
+    prefix = sha256[:16]
+    for name in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        if name.startswith(prefix) and name != keep:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+def sheet_cache_paths(file_path, cache_dir=None):#Parquet file per sheet for the workbook's current content and cache format, in CACHED_SHEETS order
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(file_path)), 'cache')
+    sha256 = source_fingerprint(file_path, cache_dir)
+    name = f"{sha256[:16]}-{cache_format()}"
+    remove_sheet_dirs(cache_dir, sha256, keep=name)#sheets an older parser cached for this workbook
+    sheet_dir = os.path.join(cache_dir, name)
+    return [os.path.join(sheet_dir, f"{sheet}.parquet") for sheet in CACHED_SHEETS]
+
+@METRICS.stage('load_data')
+def load_data(file_path, cache_dir=None, with_car_trips=True):#parsed sheets are cached as Parquet in data/cache/<hash>-<format>/, cache_dir=False always parses the workbook
+    # with_car_trips=False returns None for car trips, they are streamed from the cache (or an export) by read_car_trip_chunks instead;
+    # a cold cache still parses the whole carTrips sheet once, and if it can't be written the parsed car trips are returned after all
+    if cache_dir is False:
+        frames = parse_workbook(file_path)
+        return frames if with_car_trips else frames[:2] + (None,) + frames[3:]
+    sheet_paths = sheet_cache_paths(file_path, cache_dir)
+    sheet_dir = os.path.dirname(sheet_paths[0])
+
+    if all(os.path.exists(path) for path in sheet_paths):
+        return tuple(pd.read_parquet(path, memory_map=True) if with_car_trips or sheet != 'carTrips' else None for sheet, path in zip(CACHED_SHEETS, sheet_paths))
+
+    frames = parse_workbook(file_path)
+    os.makedirs(sheet_dir, exist_ok=True)
+    try:
+        for frame, path in zip(frames, sheet_paths):
+            frame.to_parquet(path, index=False, row_group_size=CAR_TRIP_CHUNK_ROWS)#small row groups let the car trips be streamed back
+    except (ValueError, TypeError) as e:#not expected once parse_workbook has typed the sheets, the run still goes on without the cache
+        print(f"Could not cache {file_path} as Parquet, parsing it again next run: {e}")
+        shutil.rmtree(sheet_dir, ignore_errors=True)
+        return frames#nothing to stream car trips from
+    return frames if with_car_trips else frames[:2] + (None,) + frames[3:]
+
+@METRICS.stage('preprocess_data')
+def preprocess_data(finished_visits, patient_location, patient_demographics, patients=None):#patients: a PatientDimension to enrich through instead of merging
+    if patients is not None:
+        print(f"Patient dimension changes: {patients.update(patient_location, patient_demographics)}")
+    if patients is not None and patients.can_enrich(finished_visits):
+        df = patients.enrich(finished_visits)
+    else:
+        df = pd.merge(finished_visits, patient_location, how='inner', left_on='CareEpisodeID', right_on='id')
+        df = pd.merge(df, patient_demographics, how='left', left_on='CareEpisodeID', right_on='careEpisodeID')
+    df['date'] = df['TravelToVisitStarted.StartTime'].dt.normalize()#datetime64 midnight instead of python date objects
     df['VisitFinished.event_data.finishedAt'] = pd.to_datetime(df['VisitFinished.event_data.finishedAt']).dt.tz_localize(None)#no timezone data
     return df
 
-def process_daily_data(df, car_trips): #df == preprocessed data # car_trips == car trip data with timestamps and Gps coordinates
-    distance_df = pd.DataFrame(columns=['VisitID', 'CareEpisodeID', 'CarStartTime', 'CarEndTime', 'DurationMin', 'DistanceM', 'SpanDistanceM', 'SpanCarStartTime', 'Information']) #matched car trips and visits and stats
+def geodesic_m(lat1, lon1, lat2, lon2, max_iter=200, tol=1e-12):
+    # Vincenty inverse formula on WGS-84 over numpy arrays (degrees in, metres out, inputs broadcast)
+    # agrees with geopy.distance.geodesic to well below a millimetre at the distances we care about
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2)))
+    lon_diff = lon2 - lon1
+    u1 = np.arctan((1 - WGS84_F) * np.tan(lat1))#reduced latitudes
+    u2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+    lam = lon_diff
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)#sin_sigma == 0 -> same point
+            cos2_alpha = 1 - sin_alpha ** 2
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)#cos2_alpha == 0 -> equatorial line
+            c = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = lon_diff + (1 - c) * WGS84_F * sin_alpha * (sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            if not np.any(np.abs(lam - lam_prev) >= tol):#NaN compares False, so missing coordinates don't stall the loop
+                break
+    u_sq = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) - b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+    return WGS84_B * a * (sigma - delta_sigma)
+
+def hash_keys(keys):#(n, 4) int64 rounded coordinates -> uint64 per row (splitmix64 over the columns), equal keys hash equal
+    hashes = np.zeros(len(keys), dtype=np.uint64)
+    for column in keys.T:
+        x = hashes ^ column.view(np.uint64)
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        hashes = x ^ (x >> np.uint64(31))
+    return hashes
+
+def distance_table(hashes=None, keys=None, distances=None, used=None):#cache table with a hash index over its keys, so a batch of keys is looked up in one get_indexer
+    if hashes is None:
+        hashes, keys, distances, used = np.empty(0, dtype=np.uint64), np.empty((0, 4), dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64)
+    return {'index': pd.Index(hashes), 'hashes': hashes, 'keys': keys, 'distances': distances, 'used': used}
+
+def find_keys(table, hashes, keys):#row of each key in the table, -1 when absent (a hash collision with another key counts as absent)
+    rows = table['index'].get_indexer(hashes)
+    found = rows >= 0
+    found[found] = (table['keys'][rows[found]] == keys[found]).all(axis=1)
+    return np.where(found, rows, -1)
+
+class DistanceCache:#bounded LRU of geodesic distances keyed on rounded (patient, car stop) coordinates, optionally pickled between runs
+    # the distances live in a hash-indexed table looked up in one vectorized call; a whole-day call adds its new distances to
+    # the table right away, the few of a per-visit call (spatial engine) wait in a plain dict, cheaper than re-indexing at that size
+    def __init__(self, precision=DISTANCE_CACHE_PRECISION, max_size=DISTANCE_CACHE_SIZE, path=None):
+        self.precision = precision
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lookup_s = 0.0#hashing and searching, what the hits cost instead of a geodesic
+        self.geodesic_s = 0.0#measuring the misses
+        self.sampled_s = 0.0#measuring a sample of the hits anyway, whole calls at a time
+        self.sampled_hits = 0
+        self.calls = 0#doubles as the LRU clock
+        self.table = distance_table()
+        self.recent = {}#rounded key tuple -> distance, not in the table yet
+        if path and os.path.exists(path):
+            with open(path, 'rb') as file:
+                saved = pickle.load(file)
+            if saved.get('precision') == precision and 'keys' in saved:#keys rounded differently (or an older cache layout) can't be reused
+                keys = np.asarray(saved['keys'], dtype=np.int64).reshape(-1, 4)
+                self.table = distance_table(hash_keys(keys), keys, np.asarray(saved['distances'], dtype=float), np.zeros(len(keys), dtype=np.int64))
+
+    def __len__(self):
+        return len(self.table['hashes']) + len(self.recent)
+
+    def distances_m(self, lat1, lon1, lat2, lon2):#same as geodesic_m, measured between the rounded coordinates so results don't depend on what is cached
+        start = time.perf_counter()
+        self.calls += 1
+        coordinates = np.column_stack([np.ravel(a) for a in np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in (lat1, lon1, lat2, lon2)))])
+        out = np.full(len(coordinates), np.nan)
+        finite = np.flatnonzero(np.isfinite(coordinates).all(axis=1))#missing coordinates are neither cached nor measurable
+        keys = np.rint(coordinates[finite] * 10 ** self.precision).astype(np.int64)
+        unresolved = np.arange(len(finite))
+        hashes = None
+        for store in (('recent', 'table') if len(finite) <= DISTANCE_CACHE_SMALL_CALL else ('table', 'recent')):#per-visit calls are mostly answered by the dict
+            if not len(unresolved):
+                break
+            if store == 'table' and len(self.table['hashes']):
+                hashes = hash_keys(keys[unresolved])
+                rows = find_keys(self.table, hashes, keys[unresolved])
+                hit = rows >= 0
+                out[finite[unresolved[hit]]] = self.table['distances'][rows[hit]]
+                self.table['used'][rows[hit]] = self.calls
+                unresolved, hashes = unresolved[~hit], hashes[~hit]
+            elif store == 'recent' and self.recent:
+                distances = np.array([self.recent.get(key, np.nan) for key in map(tuple, keys[unresolved].tolist())])
+                known = ~np.isnan(distances)
+                out[finite[unresolved[known]]] = distances[known]
+                unresolved = unresolved[~known]
+                hashes = None if hashes is None else hashes[~known]
+        self.hits += len(finite) - len(unresolved)
+        self.misses += len(unresolved)
+        self.lookup_s += time.perf_counter() - start
+        if len(unresolved) < len(finite) and self.sampled_hits * DISTANCE_CACHE_SAMPLE_EVERY < self.hits:#what the hits would have cost, measured on about one hit in DISTANCE_CACHE_SAMPLE_EVERY
+            start = time.perf_counter()
+            rounded = np.delete(keys, unresolved, axis=0) / 10 ** self.precision
+            geodesic_m(rounded[:, 0], rounded[:, 1], rounded[:, 2], rounded[:, 3])
+            self.sampled_s += time.perf_counter() - start
+            self.sampled_hits += len(rounded)
+
+        if len(unresolved):
+            METRICS.count('geodesic_calls', len(unresolved))#geodesics actually computed, the sampled hits above are not counted
+            start = time.perf_counter()
+            rounded = keys[unresolved] / 10 ** self.precision
+            measured = geodesic_m(rounded[:, 0], rounded[:, 1], rounded[:, 2], rounded[:, 3])
+            out[finite[unresolved]] = measured
+            self.geodesic_s += time.perf_counter() - start
+            if len(unresolved) > DISTANCE_CACHE_SMALL_CALL:
+                self._merge(hash_keys(keys[unresolved]) if hashes is None else hashes, keys[unresolved], measured)
+            else:
+                self.recent.update(zip(map(tuple, keys[unresolved].tolist()), measured.tolist()))
+                if len(self.recent) >= DISTANCE_CACHE_MERGE_ROWS:
+                    self._merge()
+        return out
+
+    def _merge(self, hashes=None, keys=None, distances=None):#recent (and the given) distances into the table, least recently used entries evicted past max_size
+        recent_keys = np.array(list(self.recent), dtype=np.int64).reshape(-1, 4)
+        recent_distances = np.fromiter(self.recent.values(), dtype=float, count=len(self.recent))
+        self.recent = {}
+        if hashes is None:
+            hashes, keys, distances = hash_keys(recent_keys), recent_keys, recent_distances
+        elif len(recent_keys):
+            hashes, keys, distances = np.concatenate([hashes, hash_keys(recent_keys)]), np.concatenate([keys, recent_keys]), np.concatenate([distances, recent_distances])
+        _, first = np.unique(hashes, return_index=True)#a pair measured twice in one call is stored once
+        new = np.setdiff1d(first, np.flatnonzero(self.table['index'].get_indexer(hashes) >= 0))#a hash already taken by another key is never cached, just measured
+        table = self.table
+        merged = [np.concatenate([table['hashes'], hashes[new]]), np.concatenate([table['keys'], keys[new]]), np.concatenate([table['distances'], distances[new]]), np.concatenate([table['used'], np.full(len(new), self.calls, dtype=np.int64)])]
+        if len(merged[0]) > self.max_size:
+            keep = np.sort(np.argpartition(-merged[3], self.max_size - 1)[:self.max_size])
+            merged = [values[keep] for values in merged]
+        self.table = distance_table(*merged)
+
+    def stats(self):#saved_s: hits times their sampled geodesic cost, minus what the lookups took (negative = the cache slows matching down)
+        lookups = self.hits + self.misses
+        per_hit_s = self.sampled_s / self.sampled_hits if self.sampled_hits else 0.0
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0, 'size': len(self),
+                'lookup_s': round(self.lookup_s, 3), 'geodesic_s': round(self.geodesic_s, 3), 'saved_s': round(self.hits * per_hit_s - self.lookup_s, 3)}
+
+    def save(self):
+        if self.path:
+            self._merge()
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'wb') as file:
+                pickle.dump({'precision': self.precision, 'keys': self.table['keys'], 'distances': self.table['distances']}, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+def measure_m(distance_cache, lat1, lon1, lat2, lon2):#geodesic distances, through the cache when one is in use
+    pairs = np.broadcast(lat1, lon1, lat2, lon2).size
+    METRICS.count('distances_requested', pairs)#cache hits included
+    if distance_cache is None:
+        METRICS.count('geodesic_calls', pairs)
+        return geodesic_m(lat1, lon1, lat2, lon2)
+    return distance_cache.distances_m(lat1, lon1, lat2, lon2)
+
+def match_day_legacy(daily_df, daily_car_trips, single_date, results, min_distance):#original row-by-row matcher, kept as the reference output
+    care_episode_counts = daily_df['CareEpisodeID'].value_counts()#Count number unique patients on that day (later, if it's one, the whole day span will be used, if >1, tighter time spans will be used)
+
+    for _, daily_row in daily_df.iterrows():#Loop through each vist in daily_df
+        found_trip = False
+        patient_id = daily_row['CareEpisodeID']
+        patient_location = (daily_row['latitude'], daily_row['longitude'])
+        visit_id = daily_row['visitId']
+        visit_finished_at = daily_row['VisitFinished.event_data.finishedAt']
+
+        for daily_car_trips_counter in range(len(daily_car_trips) - 1):#Loop through daily_car_trips to find potential matches
+            car_trip_row = daily_car_trips.iloc[daily_car_trips_counter] #loop over the car trips by index and if a match is found, loop again through start times to find the matching 'drive away' time
+            car_trip_location = (car_trip_row['location.1.latitude'], car_trip_row['location.1.longitude'])#lat long of car start point
+            car_start_time = car_trip_row['location.1.timestamp'].tz_localize(None)  # timezone-naive
+
+            time_window_before = CAR_TIME_THRESHOLD_BEFORE if care_episode_counts[patient_id] > 1 else 24#if multuple visits, use a smaller time window
+            time_window_after = CAR_TIME_THRESHOLD_AFTER if care_episode_counts[patient_id] > 1 else 24#If just one visit, use the  whole day span
+            if not (visit_finished_at - timedelta(hours=time_window_before) <= car_start_time <= visit_finished_at + timedelta(hours=time_window_after)):#Skips car trip if start time not within time window
+                continue    
+
+            METRICS.count('candidate_trips')
+            METRICS.count('distances_requested')
+            METRICS.count('geodesic_calls')
+            distance = round(1000 * geopy.distance.geodesic(patient_location, car_trip_location).km)#calcs  distance twixt patient_location and car_trip_location
+            
+            if distance < CAR_DISTANCE_THRESHOLD:   #if less than CAR_DISTANCE_TRESHOLD constant, it's a match
+                next_car_trip_row = daily_car_trips_counter + 1
+                while next_car_trip_row < len(daily_car_trips) and daily_car_trips.iloc[next_car_trip_row]['id.1'] != car_trip_row['id.1']:#continue until you get a hit 
+                    next_car_trip_row += 1
+                
+                if next_car_trip_row < len(daily_car_trips):#If you have looped through all day trips with no match, then skip this bit and go  to if_not_found_trip
+                    car_end_time = daily_car_trips.iloc[next_car_trip_row]['location.timestamp'].tz_localize(None)  # timezone-naive when trip ended
+                    duration_min = (car_end_time - car_start_time).total_seconds() / 60 #trip duration in mins
+                    span_distance = min((distance * BUCKETS_FOR_DISTANCE) // CAR_DISTANCE_THRESHOLD + 1, BUCKETS_FOR_DISTANCE - 1) #Group distances into buckets
+                    span_car_start_time = min((car_start_time.hour * BUCKET_FOR_CAR_START_TIME) // 25, BUCKET_FOR_CAR_START_TIME - 1) #Group start time into buckets
+
+                    results.add_row(visit_id, patient_id, car_start_time, car_end_time, duration_min, distance, span_distance, span_car_start_time, "match") #adds matches to results
+                    found_trip = True
+
+                    daily_car_trips = daily_car_trips.drop(daily_car_trips.index[daily_car_trips_counter]).reset_index(drop=True)#removed matched trip from daily_car_trips
+                    break
+            else:
+                min_distance = min(distance, min_distance) #If not less than CAR_DISTANCE_TRESHOLD, update mindistance 
+              
+        if not found_trip:
+            results.add_row(visit_id, patient_id, single_date, single_date, 0, min_distance, 0, 0, 'no match')#no match found, mark the row as 'no match'
+            min_distance = MIN_DISTANCE_DEFAULT
+
+    return min_distance
+
+def window_positions(car_start, num_scanned, window_start, window_end):#per visit, sorted positions of scanned trips starting inside its window, found by binary search
+    scanned_start = car_start[:num_scanned]
+    valid = np.flatnonzero(~np.isnat(scanned_start))
+    start_order = valid[np.argsort(scanned_start[valid], kind='stable')]#trips are sorted by end time, so sort start times once per day
+    sorted_start = scanned_start[start_order]
+    lower = np.searchsorted(sorted_start, window_start, side='left')
+    upper = np.searchsorted(sorted_start, window_end, side='right')
+    missing = np.isnat(window_start) | np.isnat(window_end)#visits without a finish time never match, like the legacy comparison
+    upper[missing] = lower[missing]
+    return [np.sort(start_order[low:high]) for low, high in zip(lower, upper)]
+
+def same_car_links(car_ids):#next/previous trip of the same car within the day (-1 if none), a linked list per car
+    positions = pd.Series(np.arange(len(car_ids)))
+    by_car = positions.groupby(pd.Series(car_ids), sort=False)#missing car ids are left out, like the legacy != comparison never matching them
+    next_trip = by_car.shift(-1).fillna(-1).to_numpy(dtype=np.intp)
+    previous_trip = by_car.shift(1).fillna(-1).to_numpy(dtype=np.intp)
+    return next_trip, previous_trip
+
+def consume_trip(next_trip, previous_trip, position):#unlink a matched start trip so later drive-away lookups skip it in O(1)
+    before, after = previous_trip[position], next_trip[position]
+    if before >= 0:
+        next_trip[before] = after
+    if after >= 0:
+        previous_trip[after] = before
+
+def match_day_vectorized(daily_df, daily_car_trips, single_date, results, min_distance, distance_cache=None):#same semantics as match_day_legacy, window + distances for the whole day computed up front
+    num_trips = len(daily_car_trips)
+    num_scanned = max(num_trips - 1, 0)#legacy loop never looks at the last trip of the day as a start point
+    next_trip, previous_trip = same_car_links(daily_car_trips['id.1'].to_numpy())
+    car_start = daily_car_trips['location.1.timestamp'].dt.tz_localize(None).to_numpy().astype('datetime64[ns]')
+    car_end = daily_car_trips['location.timestamp'].dt.tz_localize(None).to_numpy().astype('datetime64[ns]')
+    car_lat = daily_car_trips['location.1.latitude'].to_numpy(dtype=float)[:num_scanned]
+    car_lon = daily_car_trips['location.1.longitude'].to_numpy(dtype=float)[:num_scanned]
+
+    patient_ids = daily_df['CareEpisodeID'].to_numpy()
+    visit_ids = daily_df['visitId'].to_numpy()
+    visit_lat = daily_df['latitude'].to_numpy(dtype=float)
+    visit_lon = daily_df['longitude'].to_numpy(dtype=float)
+    visit_finished_at = daily_df['VisitFinished.event_data.finishedAt'].to_numpy().astype('datetime64[ns]')
+
+    multiple_visits = daily_df['CareEpisodeID'].map(daily_df['CareEpisodeID'].value_counts()).to_numpy() > 1#patients with several visits get the tight window, the rest the whole day span
+    window_start = visit_finished_at - np.where(multiple_visits, np.timedelta64(CAR_TIME_THRESHOLD_BEFORE, 'h'), np.timedelta64(24, 'h'))
+    window_end = visit_finished_at + np.where(multiple_visits, np.timedelta64(CAR_TIME_THRESHOLD_AFTER, 'h'), np.timedelta64(24, 'h'))
+
+    in_window = window_positions(car_start, num_scanned, window_start, window_end)
+    window_sizes = np.array([len(positions) for positions in in_window], dtype=np.intp)
+    pair_visits = np.repeat(np.arange(len(daily_df)), window_sizes)#only measure pairs inside the time window, all in one call
+    pair_trips = np.concatenate(in_window) if len(in_window) else np.empty(0, dtype=np.intp)
+    METRICS.count('candidate_trips', len(pair_trips))
+    distances = np.split(np.rint(measure_m(distance_cache, visit_lat[pair_visits], visit_lon[pair_visits], car_lat[pair_trips], car_lon[pair_trips])), np.cumsum(window_sizes)[:-1])
+
+    consumed = np.zeros(num_trips, dtype=bool)#matched trips are consumed instead of dropped
+    for visit in range(len(daily_df)):
+        unconsumed = ~consumed[in_window[visit]]
+        positions = in_window[visit][unconsumed]
+        visit_distances = distances[visit][unconsumed]
+        match = None
+        for candidate in np.flatnonzero(visit_distances < CAR_DISTANCE_THRESHOLD):#walk close trips in trip order, first one with a drive-away trip wins
+            start_position = positions[candidate]
+            if next_trip[start_position] >= 0:
+                match = (candidate, start_position, next_trip[start_position])
+                break
+
+        scanned_distances = visit_distances if match is None else visit_distances[:match[0]]
+        far_distances = scanned_distances[scanned_distances >= CAR_DISTANCE_THRESHOLD]
+        if len(far_distances):
+            min_distance = min(int(far_distances.min()), min_distance)
+
+        if match is None:
+            results.add_row(visit_ids[visit], patient_ids[visit], single_date, single_date, 0, min_distance, 0, 0, 'no match')
+            min_distance = MIN_DISTANCE_DEFAULT
+            continue
+
+        candidate, start_position, end_position = match
+        distance = int(visit_distances[candidate])
+        car_start_time = pd.Timestamp(car_start[start_position])
+        car_end_time = pd.Timestamp(car_end[end_position])
+        duration_min = (car_end_time - car_start_time).total_seconds() / 60
+        span_distance = min((distance * BUCKETS_FOR_DISTANCE) // CAR_DISTANCE_THRESHOLD + 1, BUCKETS_FOR_DISTANCE - 1)
+        span_car_start_time = min((car_start_time.hour * BUCKET_FOR_CAR_START_TIME) // 25, BUCKET_FOR_CAR_START_TIME - 1)
+        results.add_row(visit_ids[visit], patient_ids[visit], car_start_time, car_end_time, duration_min, distance, span_distance, span_car_start_time, "match")
+        consumed[start_position] = True
+        consume_trip(next_trip, previous_trip, start_position)
+
+    return min_distance
+
+def _nearest_far_distance(tree, indexed_positions, visit_lat, visit_lon, car_lat, car_lon, eligible, measured, cap, k=SPATIAL_KNN, distance_cache=None):
+    # smallest rounded distance >= CAR_DISTANCE_THRESHOLD among eligible trips if it is below cap (the carried min_distance), else cap;
+    # the kNN query grows until the next neighbour is provably farther than cap, and only eligible stops under cap get a geodesic
+    # measured: trips whose distance is already known (radius candidates, the day's first kNN batch), skipped here
+    point = np.radians([[visit_lat, visit_lon]])
+    while True:
+        k = min(k, len(indexed_positions))
+        haversine, neighbours = tree.query(point, k=k)#sorted by distance
+        lower_bounds = haversine[0] * EARTH_RADIUS_M * (1 - GEODESIC_TOLERANCE)
+        positions = indexed_positions[neighbours[0]]
+        todo = eligible[positions] & ~measured[positions] & (lower_bounds < cap)
+        measured[positions] = True
+        if todo.any():
+            METRICS.count('candidate_trips', todo.sum())
+            distances = np.rint(measure_m(distance_cache, visit_lat, visit_lon, car_lat[positions[todo]], car_lon[positions[todo]]))
+            far = distances[distances >= CAR_DISTANCE_THRESHOLD]
+            if len(far):
+                cap = min(cap, far.min())
+        if k == len(indexed_positions) or lower_bounds[-1] >= cap:#nothing further out can be closer than cap
+            return cap
+        k *= 4
+
+def match_day_spatial(daily_df, daily_car_trips, single_date, results, min_distance, distance_cache=None):#same semantics as match_day_legacy, candidates come from a per-day haversine BallTree
+    num_trips = len(daily_car_trips)
+    num_scanned = max(num_trips - 1, 0)#legacy loop never looks at the last trip of the day as a start point
+    next_trip, previous_trip = same_car_links(daily_car_trips['id.1'].to_numpy())
+    car_start = daily_car_trips['location.1.timestamp'].dt.tz_localize(None).to_numpy().astype('datetime64[ns]')
+    car_end = daily_car_trips['location.timestamp'].dt.tz_localize(None).to_numpy().astype('datetime64[ns]')
+    car_lat = daily_car_trips['location.1.latitude'].to_numpy(dtype=float)
+    car_lon = daily_car_trips['location.1.longitude'].to_numpy(dtype=float)
+
+    patient_ids = daily_df['CareEpisodeID'].to_numpy()
+    visit_ids = daily_df['visitId'].to_numpy()
+    visit_lat = daily_df['latitude'].to_numpy(dtype=float)
+    visit_lon = daily_df['longitude'].to_numpy(dtype=float)
+    visit_finished_at = daily_df['VisitFinished.event_data.finishedAt'].to_numpy().astype('datetime64[ns]')
+
+    multiple_visits = daily_df['CareEpisodeID'].map(daily_df['CareEpisodeID'].value_counts()).to_numpy() > 1
+    window_start = visit_finished_at - np.where(multiple_visits, np.timedelta64(CAR_TIME_THRESHOLD_BEFORE, 'h'), np.timedelta64(24, 'h'))
+    window_end = visit_finished_at + np.where(multiple_visits, np.timedelta64(CAR_TIME_THRESHOLD_AFTER, 'h'), np.timedelta64(24, 'h'))
+
+    indexed_positions = np.flatnonzero(np.isfinite(car_lat[:num_scanned]) & np.isfinite(car_lon[:num_scanned]))#trips the index can hold
+    tree = BallTree(np.radians(np.column_stack([car_lat[indexed_positions], car_lon[indexed_positions]])), metric='haversine') if len(indexed_positions) else None
+    visit_points = np.radians(np.column_stack([visit_lat, visit_lon]))
+    searchable = np.flatnonzero(np.isfinite(visit_points).all(axis=1))
+    nearby = [np.empty(0, dtype=np.intp)] * len(daily_df)
+    knn_positions = np.empty((len(daily_df), 0), dtype=np.intp)
+    if tree is not None and len(searchable):
+        radius = CAR_DISTANCE_THRESHOLD * (1 + GEODESIC_TOLERANCE) / EARTH_RADIUS_M
+        for visit, neighbours in zip(searchable, tree.query_radius(visit_points[searchable], r=radius)):#one batched radius query for the whole day
+            nearby[visit] = np.sort(indexed_positions[neighbours])
+        knn = min(SPATIAL_KNN, len(indexed_positions))#nearest stops of every visit, enough to settle min_distance for most of them
+        haversine, neighbours = tree.query(visit_points[searchable], k=knn)
+        knn_positions = np.full((len(daily_df), knn), -1, dtype=np.intp)
+        knn_positions[searchable] = indexed_positions[neighbours]
+        knn_bounds = np.full(len(daily_df), np.inf)#lower bound on the distance of any stop past the batch
+        knn_bounds[searchable] = haversine[:, -1] * EARTH_RADIUS_M * (1 - GEODESIC_TOLERANCE)
+
+    nearby_sizes = np.array([len(positions) for positions in nearby], dtype=np.intp)
+    knn_rows = np.flatnonzero((knn_positions >= 0).all(axis=1)) if knn_positions.shape[1] else np.empty(0, dtype=np.intp)
+    pair_visits = np.concatenate([np.repeat(np.arange(len(daily_df)), nearby_sizes), np.repeat(knn_rows, knn_positions.shape[1])])
+    pair_trips = np.concatenate([np.concatenate(nearby) if len(nearby) else np.empty(0, dtype=np.intp), knn_positions[knn_rows].ravel()])
+    METRICS.count('candidate_trips', len(pair_trips))#radius and kNN stops alike, all measured here in one call
+    pair_distances = np.rint(measure_m(distance_cache, visit_lat[pair_visits], visit_lon[pair_visits], car_lat[pair_trips], car_lon[pair_trips]))
+    nearby_distances = np.split(pair_distances[:nearby_sizes.sum()], np.cumsum(nearby_sizes)[:-1])
+    knn_distances = np.full(knn_positions.shape, np.nan)
+    knn_distances[knn_rows] = pair_distances[nearby_sizes.sum():].reshape(knn_positions[knn_rows].shape)
+
+    in_window = window_positions(car_start, num_scanned, window_start, window_end)
+    consumed = np.zeros(num_trips, dtype=bool)
+    for visit in range(len(daily_df)):
+        eligible = np.zeros(num_trips, dtype=bool)
+        eligible[in_window[visit]] = True
+        eligible &= ~consumed
+
+        usable = eligible[nearby[visit]]
+        candidates = nearby[visit][usable]
+        candidate_distances = nearby_distances[visit][usable]
+        match = None
+        for start_position, distance in zip(candidates, candidate_distances):#candidates are in trip order, first close one with a drive-away trip wins
+            if distance >= CAR_DISTANCE_THRESHOLD:
+                continue
+            if next_trip[start_position] >= 0:
+                match = (start_position, next_trip[start_position], int(distance))
+                break
+
+        if match is not None:
+            eligible[match[0]:] = False#the legacy scan stops at the matched trip
+        if eligible.any() and min_distance > CAR_DISTANCE_THRESHOLD:#a far stop can't lower min_distance below the threshold
+            known_positions = np.concatenate([candidates, knn_positions[visit][knn_positions[visit] >= 0]])
+            known_distances = np.concatenate([candidate_distances, knn_distances[visit][knn_positions[visit] >= 0]])
+            far = known_distances[eligible[known_positions] & (known_distances >= CAR_DISTANCE_THRESHOLD)]
+            if len(far):
+                min_distance = min(int(far.min()), min_distance)
+            if knn_positions.shape[1] and knn_positions[visit, 0] >= 0 and knn_bounds[visit] < min_distance and knn_positions.shape[1] < len(indexed_positions):#stops past the batch could still be closer
+                measured = np.zeros(num_trips, dtype=bool)
+                measured[known_positions] = True
+                min_distance = int(_nearest_far_distance(tree, indexed_positions, visit_lat[visit], visit_lon[visit], car_lat, car_lon, eligible, measured, min_distance, SPATIAL_KNN * 4, distance_cache))
+
+        if match is None:
+            results.add_row(visit_ids[visit], patient_ids[visit], single_date, single_date, 0, min_distance, 0, 0, 'no match')
+            min_distance = MIN_DISTANCE_DEFAULT
+            continue
+
+        start_position, end_position, distance = match
+        car_start_time = pd.Timestamp(car_start[start_position])
+        car_end_time = pd.Timestamp(car_end[end_position])
+        duration_min = (car_end_time - car_start_time).total_seconds() / 60
+        span_distance = min((distance * BUCKETS_FOR_DISTANCE) // CAR_DISTANCE_THRESHOLD + 1, BUCKETS_FOR_DISTANCE - 1)
+        span_car_start_time = min((car_start_time.hour * BUCKET_FOR_CAR_START_TIME) // 25, BUCKET_FOR_CAR_START_TIME - 1)
+        results.add_row(visit_ids[visit], patient_ids[visit], car_start_time, car_end_time, duration_min, distance, span_distance, span_car_start_time, "match")
+        consumed[start_position] = True
+        consume_trip(next_trip, previous_trip, start_position)
+
+    return min_distance
+
+MATCHERS = {
+    'legacy': match_day_legacy,
+    'vectorized': match_day_vectorized,
+    'spatial': match_day_spatial,
+}
+
+class DatePartition:#row positions of each calendar day, built once so fetching a day is a binary search instead of a full-frame mask
+    def __init__(self, timestamps):
+        days = timestamps.dt.tz_localize(None).to_numpy().astype('datetime64[D]')#local calendar day, NaT sorts last
+        self.order = np.argsort(days, kind='stable')#stable keeps each day's rows in frame order
+        self.sorted_days = days[self.order]
+
+    def positions(self, date):
+        day = np.datetime64(date, 'D')
+        return self.order[np.searchsorted(self.sorted_days, day, side='left'):np.searchsorted(self.sorted_days, day, side='right')]
+
+    def dates(self):
+        days = np.unique(self.sorted_days[~np.isnat(self.sorted_days)])
+        return [pd.Timestamp(day) for day in days]
+
+def get_matcher(engine, distance_cache=None):
+    if engine not in MATCHERS:
+        raise ValueError(f"Unknown matching engine '{engine}', expected one of {sorted(MATCHERS)}")
+    if distance_cache is None:
+        return MATCHERS[engine]
+    if engine == 'legacy':
+        raise ValueError("The legacy engine measures with geopy and can't use a distance cache")
+    return partial(MATCHERS[engine], distance_cache=distance_cache)
+
+def match_date(daily_df, daily_car_trips, single_date, results, min_distance, match_day):#one calendar day, returns the carried min_distance
+    first_row = len(results)
+    with METRICS.on_day(single_date.date()):
+        METRICS.count('visits', len(daily_df))
+        METRICS.count('car_trips', len(daily_car_trips))
+        if daily_car_trips.empty and not daily_df.empty:#if no car trips on that date, mark day with 'no car trips'
+            results.add_row(0, 0, single_date, single_date, 0, 0, 0, 0, 'no car trips this date')
+        else:
+            min_distance = match_day(daily_df, daily_car_trips, single_date, results, min_distance)
+        if METRICS.enabled:
+            for info in results.info[first_row:]:
+                METRICS.count(INFO_COUNTERS.get(info, info))
+    return min_distance
+
+@METRICS.stage('matching')
+def process_daily_data(df, car_trips, engine=MATCHING_ENGINE, distance_cache=None): #df == preprocessed data # car_trips == car trip data with timestamps and Gps coordinates
+    match_day = get_matcher(engine, distance_cache)
+    results = DistanceResults() #matched car trips and visits and stats
     start_date = df['TravelToVisitStarted.StartTime'].min().date()
     end_date = df['TravelToVisitStarted.StartTime'].max().date()
-    no_match_count = 0
-    min_distance = MIN_DISTANCE_DEFAULT
+    min_distance = MIN_DISTANCE_DEFAULT #carried over between visits until a 'no match' row reports it
+
+    visit_days = DatePartition(df['TravelToVisitStarted.StartTime'])
+    trip_days = DatePartition(car_trips['location.1.timestamp'])
 
     for single_date in pd.date_range(start=start_date, end=end_date):#Iterate over all dates
-        daily_df = df[df['TravelToVisitStarted.StartTime'].dt.date == single_date.date()]#Filter daily_df for current date
-        daily_car_trips = car_trips[car_trips['location.1.timestamp'].dt.date == single_date.date()]#filter car_trips for current date
+        daily_df = df.iloc[visit_days.positions(single_date.date())]#visits for current date
+        daily_car_trips = car_trips.iloc[trip_days.positions(single_date.date())]#car_trips for current date
+        min_distance = match_date(daily_df, daily_car_trips, single_date, results, min_distance, match_day)
 
-        if daily_car_trips.empty and not daily_df.empty:#if no car trips on that date, mark day with 'no car trips'
-            distance_df = add_new_row(distance_df, 0, 0, single_date, single_date, 0, 0, 0, 0, 'no car trips this date')
+    return results.to_frame()
+
+@METRICS.stage('matching')
+def match_dates(df, car_trips, engine=MATCHING_ENGINE, distance_cache=None):#every date matched on its own, min_distance starts from MIN_DISTANCE_DEFAULT each day
+    match_day = get_matcher(engine, distance_cache)
+    results = DistanceResults()
+    visit_days = DatePartition(df['TravelToVisitStarted.StartTime'])
+    trip_days = DatePartition(car_trips['location.1.timestamp'])
+    for single_date in visit_days.dates():
+        match_date(df.iloc[visit_days.positions(single_date)], car_trips.iloc[trip_days.positions(single_date)], single_date, results, MIN_DISTANCE_DEFAULT, match_day)
+    return results.to_frame()
+
+@METRICS.stage('matching')
+def process_daily_data_parallel(df, car_trips, workers=None, chunk_days=7, engine=MATCHING_ENGINE):#chunks of chunk_days dates are matched in a process pool, results come back in date order
+    get_matcher(engine)#fail before starting workers
+    visits = df[MATCHING_VISIT_COLUMNS]#only ship what matching reads to the workers
+    trips = car_trips[MATCHING_TRIP_COLUMNS]
+    start_date = pd.Timestamp(visits['TravelToVisitStarted.StartTime'].min().date())
+    visit_chunks = (visits['TravelToVisitStarted.StartTime'].dt.normalize().dt.tz_localize(None) - start_date).dt.days // chunk_days
+    trip_chunks = (trips['location.1.timestamp'].dt.normalize().dt.tz_localize(None) - start_date).dt.days // chunk_days
+    trips_by_chunk = dict(tuple(trips.groupby(trip_chunks, sort=False)))
+    chunks = [(chunk_visits, trips_by_chunk.get(chunk, trips.iloc[0:0])) for chunk, chunk_visits in visits.groupby(visit_chunks, sort=True)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        frames = list(executor.map(match_dates, [chunk_visits for chunk_visits, _ in chunks], [chunk_trips for _, chunk_trips in chunks], [engine] * len(chunks)))
+    if not frames:
+        return DistanceResults().to_frame()
+    return pd.concat(frames, ignore_index=True)
+
+def read_car_trip_chunks(path, chunk_rows=CAR_TRIP_CHUNK_ROWS):#car trips from a CSV or Parquet export (or the cached sheet), chunk_rows at a time, only the columns matching reads
+    if path.endswith('.parquet'):
+        batches = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=MATCHING_TRIP_COLUMNS))
+    else:
+        batches = pd.read_csv(path, chunksize=chunk_rows, usecols=MATCHING_TRIP_COLUMNS)
+    for chunk in batches:
+        for column in ['location.1.timestamp', 'location.timestamp']:
+            chunk[column] = pd.to_datetime(chunk[column])
+        yield chunk
+
+def car_trip_days(chunks):#(date, that day's car trips) in date order, from chunks sorted by location.timestamp
+    # a trip parks (location.1.timestamp) after it set off (location.timestamp), so once the stream has set off past
+    # midnight every trip parking on the earlier days has been read, only the days still open are buffered
+    buffered = []
+    last_day = None
+    for chunk in chunks:
+        buffered.append(chunk)
+        trips = pd.concat(buffered, ignore_index=True) if len(buffered) > 1 else chunk
+        days = trips['location.1.timestamp'].dt.tz_localize(None).dt.normalize()
+        if last_day is not None and (days <= last_day).any():
+            raise ValueError("Car trips must be sorted by location.timestamp to be streamed")
+        open_from = trips['location.timestamp'].dt.tz_localize(None).max().normalize()
+        done = (days < open_from).to_numpy()
+        for day, day_trips in trips[done].groupby(days[done], sort=True):
+            yield day, day_trips.sort_values(by='location.timestamp', kind='stable')
+            last_day = day
+        buffered = [trips[~done & days.notna().to_numpy()]]#trips without a parking time never match a day
+    if buffered:
+        trips = buffered[0]
+        days = trips['location.1.timestamp'].dt.tz_localize(None).dt.normalize()
+        for day, day_trips in trips.groupby(days, sort=True):
+            yield day, day_trips.sort_values(by='location.timestamp', kind='stable')
+
+@METRICS.stage('matching')
+def process_daily_data_streaming(df, trip_days, engine=MATCHING_ENGINE, distance_cache=None):#same output as process_daily_data, car trips come one day at a time from car_trip_days
+    match_day = get_matcher(engine, distance_cache)
+    results = DistanceResults()
+    start_date = df['TravelToVisitStarted.StartTime'].min().date()
+    end_date = df['TravelToVisitStarted.StartTime'].max().date()
+    min_distance = MIN_DISTANCE_DEFAULT
+    visit_days = DatePartition(df['TravelToVisitStarted.StartTime'])
+    no_trips = pd.DataFrame(columns=MATCHING_TRIP_COLUMNS)
+
+    trip_days = iter(trip_days)
+    next_day = next(trip_days, None)
+    for single_date in pd.date_range(start=start_date, end=end_date):
+        while next_day is not None and next_day[0] < single_date:#telemetry from before the first visit, or days already passed
+            next_day = next(trip_days, None)
+        daily_car_trips = no_trips
+        if next_day is not None and next_day[0] == single_date:
+            daily_car_trips = next_day[1]
+            next_day = next(trip_days, None)
+        daily_df = df.iloc[visit_days.positions(single_date.date())]
+        if daily_df.empty:#a day without visits adds no rows and leaves min_distance alone
             continue
+        min_distance = match_date(daily_df, daily_car_trips, single_date, results, min_distance, match_day)
 
-        care_episode_counts = daily_df['CareEpisodeID'].value_counts()#Count number unique patients on that day (later, if it's one, the whole day span will be used, if >1, tighter time spans will be used)
+    return results.to_frame()
 
-        for _, daily_row in daily_df.iterrows():#Loop through each vist in daily_df
-            found_trip = False
-            patient_id = daily_row['CareEpisodeID']
-            patient_location = (daily_row['latitude'], daily_row['longitude'])
-            visit_id = daily_row['visitId']
-            visit_finished_at = daily_row['VisitFinished.event_data.finishedAt']
+def row_fingerprints(frame, columns):#64-bit content hash per row, a day's key hashes its rows' fingerprints in row order
+    return pd.util.hash_pandas_object(frame[columns], index=False).to_numpy()
 
-            for daily_car_trips_counter in range(len(daily_car_trips) - 1):#Loop through daily_car_trips to find potential matches
-                car_trip_row = daily_car_trips.iloc[daily_car_trips_counter] #loop over the car trips by index and if a match is found, loop again through start times to find the matching 'drive away' time
-                car_trip_location = (car_trip_row['location.1.latitude'], car_trip_row['location.1.longitude'])#lat long of car start point
-                car_start_time = car_trip_row['location.1.timestamp'].tz_localize(None)  # timezone-naive
+@METRICS.stage('matching')
+def process_daily_data_incremental(df, car_trips, daily_results_dir, engine=MATCHING_ENGINE, distance_cache=None):#only re-matches dates whose visits or car trips changed since the last run
+    # every date starts from MIN_DISTANCE_DEFAULT so a day's result only depends on that day's inputs
+    # (the full run carries min_distance across midnight, which only shows in the first 'no match' row of a day)
+    match_day = get_matcher(engine, distance_cache)
+    precision = distance_cache.precision if distance_cache is not None else None#cached distances are measured between rounded coordinates and can differ by 1 m
+    settings = json.dumps([DAILY_RESULTS_VERSION, DISTANCE_COLUMNS, DISTANCE_SCHEMA, engine, precision, CAR_DISTANCE_THRESHOLD, CAR_TIME_THRESHOLD_BEFORE, CAR_TIME_THRESHOLD_AFTER, BUCKETS_FOR_DISTANCE, BUCKET_FOR_CAR_START_TIME], default=repr)#repr keeps the Information categories
+    visit_hashes = row_fingerprints(df, MATCHING_VISIT_COLUMNS)
+    trip_hashes = row_fingerprints(car_trips, MATCHING_TRIP_COLUMNS)
+    visit_days = DatePartition(df['TravelToVisitStarted.StartTime'])
+    trip_days = DatePartition(car_trips['location.1.timestamp'])
 
-                time_window_before = CAR_TIME_THRESHOLD_BEFORE if care_episode_counts[patient_id] > 1 else 24#if multuple visits, use a smaller time window
-                time_window_after = CAR_TIME_THRESHOLD_AFTER if care_episode_counts[patient_id] > 1 else 24#If just one visit, use the  whole day span
-                if not (visit_finished_at - timedelta(hours=time_window_before) <= car_start_time <= visit_finished_at + timedelta(hours=time_window_after)):#Skips car trip if start time not within time window
-                    continue    
+    manifest_path = os.path.join(daily_results_dir, CACHE_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+    os.makedirs(daily_results_dir, exist_ok=True)
 
-                distance = round(1000 * geopy.distance.geodesic(patient_location, car_trip_location).km)#calcs  distance twixt patient_location and car_trip_location
-                
-                if distance < CAR_DISTANCE_THRESHOLD:   #if less than CAR_DISTANCE_TRESHOLD constant, it's a match
-                    next_car_trip_row = daily_car_trips_counter + 1
-                    while next_car_trip_row < len(daily_car_trips) and daily_car_trips.iloc[next_car_trip_row]['id.1'] != car_trip_row['id.1']:#continue until you get a hit 
-                        next_car_trip_row += 1
-                    
-                    if next_car_trip_row < len(daily_car_trips):#If you have looped through all day trips with no match, then skip this bit and go  to if_not_found_trip
-                        car_end_time = daily_car_trips.iloc[next_car_trip_row]['location.timestamp'].tz_localize(None)  # timezone-naive when trip ended
-                        duration_min = (car_end_time - car_start_time).total_seconds() / 60 #trip duration in mins
-                        span_distance = min((distance * BUCKETS_FOR_DISTANCE) // CAR_DISTANCE_THRESHOLD + 1, BUCKETS_FOR_DISTANCE - 1) #Group distances into buckets
-                        span_car_start_time = min((car_start_time.hour * BUCKET_FOR_CAR_START_TIME) // 25, BUCKET_FOR_CAR_START_TIME - 1) #Group start time into buckets
-
-                        distance_df = add_new_row(distance_df, visit_id, patient_id, car_start_time, car_end_time, duration_min, distance, span_distance, span_car_start_time, "match") #adds matches to distance_df
-                        found_trip = True
-
-                        daily_car_trips = daily_car_trips.drop(daily_car_trips.index[daily_car_trips_counter]).reset_index(drop=True)#removed matched trip from daily_car_trips
-                        break
-                else:
-                    min_distance = min(distance, min_distance) #If not less than CAR_DISTANCE_TRESHOLD, update mindistance 
-                  
-            if not found_trip:
-                no_match_count += 1
-                distance_df = add_new_row(distance_df, visit_id, patient_id, single_date, single_date, 0, min_distance, 0, 0, 'no match')#no match found, mark the row as 'no match'
-                min_distance = MIN_DISTANCE_DEFAULT
-
-    return distance_df
-
-def save_results(df, distance_df, finished_occurrences, output_file_path):
-    distance_df.to_excel(output_file_path, index=False, engine='openpyxl')
+    daily_frames = []
+    new_manifest = {}
+    recomputed = 0
+    for single_date in visit_days.dates():#dates without visits never produce rows
+        visit_positions = visit_days.positions(single_date)
+        trip_positions = trip_days.positions(single_date)
+        day = single_date.date().isoformat()
+        day_key = hashlib.sha256(settings.encode() + visit_hashes[visit_positions].tobytes() + b'|' + trip_hashes[trip_positions].tobytes()).hexdigest()
+        day_path = os.path.join(daily_results_dir, f"{day}.parquet")
+        if manifest.get(day) == day_key and os.path.exists(day_path):
+            daily_frames.append(pd.read_parquet(day_path))
+        else:
+            results = DistanceResults()
+            match_date(df.iloc[visit_positions], car_trips.iloc[trip_positions], single_date, results, MIN_DISTANCE_DEFAULT, match_day)
+            day_frame = results.to_frame()
+            day_frame.to_parquet(day_path, index=False)
+            daily_frames.append(day_frame)
+            recomputed += 1
+        new_manifest[day] = day_key
+
+    for day in set(manifest) - set(new_manifest):#dates that no longer have visits
+        stale_path = os.path.join(daily_results_dir, f"{day}.parquet")
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+    with open(manifest_path, 'w') as file:
+        json.dump(new_manifest, file, indent=2)
+
+    print(f"Incremental matching: {recomputed} of {len(new_manifest)} dates recomputed")
+    if not daily_frames:
+        return DistanceResults().to_frame()
+    return pd.concat(daily_frames, ignore_index=True)
+
+@METRICS.stage('save_results')
+def save_results(df, distance_df, finished_occurrences, processed_file_path, excel_file_path=None):
     df = pd.merge(df, distance_df, how='inner', left_on='visitId', right_on='VisitID')#how was left, but merged blank values so now inner to drop visits that lack car trip data NaN values
     df = pd.merge(df, finished_occurrences, how='inner', left_on='visitId', right_on='ActivityOccurenceEvents.event_data.visitId')#merging activities to the processed visits, so mutiple activities might merge to single visit IDs
-    df.to_excel(output_file_path, index=False, engine='openpyxl')
+    save_processed_data(df, processed_file_path)#Parquet hand-off the model scripts read
+    if excel_file_path:#optional report for reading in a spreadsheet
+        df.to_excel(excel_file_path, index=False, engine='openpyxl')
+    return df
 
 # Main
-config = ConfigLoader('/home/tomas/GitHub/ITHS-AI/config/config.yaml')
-file_path = config.get_file_path()  # Get the correct file path
-output_file_path = config.get_output_file_path()  # Get the correct output file path
-
-finished_occurrences, finished_visits, car_trips, patient_location, patient_demographics = load_data(file_path)
-df = preprocess_data(finished_visits, patient_location, patient_demographics)
-distance_df = process_daily_data(df, car_trips)
-save_results(df, distance_df, finished_occurrences, output_file_path)
+if __name__ == "__main__":
+    config = ConfigLoader()
+    file_path = config.get_file_path()  # Get the correct file path
+    processed_file_path = config.get_processed_file_path()  # Parquet dataset for the model scripts
+    excel_file_path = config.get_output_file_path() if config.config.get('export_excel') else None  # Excel copy only when asked for
+    preprocessing = config.config.get('preprocessing', {})
+    metrics = preprocessing.get('metrics') or {}
+    metrics_dir = metrics.get('report_dir') or os.path.join(config.get_data_dir(), 'metrics')
+    METRICS.configure(enabled=metrics.get('enabled', False), profile=metrics.get('profile', False), trace_memory=metrics.get('trace_memory', False), profile_dir=metrics_dir)
+
+    stream_car_trips = preprocessing.get('stream_car_trips', False)
+    car_trips_path = preprocessing.get('car_trips_path')
+    if stream_car_trips and car_trips_path and not os.path.exists(car_trips_path):#fail before the workbook is parsed
+        raise FileNotFoundError(f"preprocessing.car_trips_path {car_trips_path} does not exist")
+    finished_occurrences, finished_visits, car_trips, patient_location, patient_demographics = load_data(file_path, with_car_trips=not stream_car_trips)
+    if stream_car_trips and car_trips is not None and not car_trips_path:#the sheet cache couldn't be written, so there is no Parquet to stream
+        print("carTrips sheet is not cached as Parquet, matching the car trips in memory instead of streaming them")
+        stream_car_trips = False
+    cache_dir = os.path.join(os.path.dirname(file_path), 'cache')
+    patients = PatientDimension(os.path.join(cache_dir, 'patients')) if preprocessing.get('patient_dimension', True) else None
+    df = preprocess_data(finished_visits, patient_location, patient_demographics, patients)
+    engine = preprocessing.get('engine') or MATCHING_ENGINE
+    distance_cache = None
+    if preprocessing.get('distance_cache'):
+        distance_cache = DistanceCache(precision=preprocessing.get('distance_cache_precision', DISTANCE_CACHE_PRECISION), path=os.path.join(cache_dir, 'distances.pkl'))
+    if stream_car_trips:
+        car_trips_path = car_trips_path or sheet_cache_paths(file_path)[CACHED_SHEETS.index('carTrips')]
+        trip_days = car_trip_days(read_car_trip_chunks(car_trips_path, preprocessing.get('car_trip_chunk_rows', CAR_TRIP_CHUNK_ROWS)))
+        distance_df = process_daily_data_streaming(df, trip_days, engine=engine, distance_cache=distance_cache)
+    elif preprocessing.get('incremental'):
+        distance_df = process_daily_data_incremental(df, car_trips, preprocessing.get('daily_results_dir') or os.path.join(cache_dir, 'daily'), engine=engine, distance_cache=distance_cache)
+    elif preprocessing.get('workers', 1) != 1:
+        distance_df = process_daily_data_parallel(df, car_trips, workers=preprocessing['workers'], chunk_days=preprocessing.get('chunk_days', 7), engine=engine)#each worker measures on its own, no shared cache
+    else:
+        distance_df = process_daily_data(df, car_trips, engine=engine, distance_cache=distance_cache)
+    if distance_cache is not None:
+        cache_stats = distance_cache.stats()
+        print(f"Distance cache: {cache_stats}")
+        METRICS.count('distance_cache_hits', cache_stats['hits'])
+        METRICS.count('distance_cache_misses', cache_stats['misses'])
+        METRICS.count('distance_cache_saved_ms', 1000 * cache_stats['saved_s'])
+        distance_cache.save()
+    save_results(df, distance_df, finished_occurrences, processed_file_path, excel_file_path)
+    if METRICS.enabled:
+        METRICS.summary()
+        METRICS.write(os.path.join(metrics_dir, f"preprocess-{METRICS.started:%Y%m%d-%H%M%S}.json"))
 
 #config = load_config('/home/tomas/GitHub/AImed/config/config.yaml')
 #  windows: "C:\\Users\\tomas\\Documents\\GitHub\\AImed\\config\\config.yaml"
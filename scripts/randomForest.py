@@ -1,59 +1,58 @@
 import pandas as pd
-from sklearn.model_selection import train_test_split, cross_val_score
+from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import mean_squared_error, r2_score
 import matplotlib.pyplot as plt
 import os
+import time
+
+from config_loader import ConfigLoader
+from dataset import MODEL_COLUMNS, file_version, load_processed_data
+from evaluation import cross_validate_model, print_results, regression_metrics, write_results
+from features import TARGET, VisitFeatureEncoder, report_missing
+from model_registry import register_model, reusable_model
 
 # Load and filter the dataset
-file_path = "/home/tomas/GitHub/ITHS-AI/data/df.xlsx"
 #config = load_config('/home/tomas/GitHub/AImed/config/config.yaml')
 #  windows: "C:\\Users\\jenny\\Documents\\GitHub\\AImed\\config\\config.yaml"
 #  mac: "/Users/tomas/Documents/GitHub/AImed/config/config.yaml"
 #  linux: "/home/tomas/GitHub/AImed/config/config.yaml"
 
-df = pd.read_excel(file_path)
+df = load_processed_data(columns=MODEL_COLUMNS)
 df = df[df['Information'] == 'match'] #just use matched rows
 
-# Define features and target
-df_features = df[['Activities.ActivityCategory', 'Activities.doubleStaffing', 'gender',  'ageSpan', 'SpanDistanceM', 'SpanCarStartTime']]
-
-# Target encoding for Activities.ActivityCategory
-activity_category_means = df.groupby('Activities.ActivityCategory')['DurationMin'].mean()
-df_features['Activities.ActivityCategory'] = df_features['Activities.ActivityCategory'].map(activity_category_means)
-df_features = df_features.drop(columns=['Activities.ActivityCategory'])
+# A registered model trained on this exact data with these params is loaded instead of refitted
+params = ConfigLoader().get_model_params('random_forest')#config.yaml random_forest.params, or the tuned ones
+data_version = file_version(ConfigLoader().get_processed_file_path())
+registered = reusable_model('RandomForest', data_version, params)
 
-# One-hot encoding for other categorical features
-categorical_features = ['Activities.doubleStaffing', 'gender', 'ageSpan', 'SpanDistanceM', 'SpanCarStartTime']
-df_features = pd.get_dummies(df_features, columns=categorical_features, drop_first=True)#drop first redundant column of dummy variables
+# One-hot encoding for the categorical features, fitted once and registered with the model for inference
+encoder = registered.encoder if registered else VisitFeatureEncoder().fit(df, df[TARGET])
+df_features = encoder.transform(df)
 
-target = df['DurationMin']
+target = df[TARGET]
 
 # Check for NaN values
-if df_features.isnull().any().any():
-    print("Features contain NaN")
-if target.isnull().any():
-    print("Target contains NaN")
+report_missing(df_features, target)
 
 # Split into train and test sets
 x_train, x_test, y_train, y_test = train_test_split(df_features, target, test_size=0.2, random_state=4562)
 
-# Fit the Random Forest Regressor model
-model = RandomForestRegressor(n_estimators=100, random_state=42)
-model.fit(x_train, y_train)
+# Fit the Random Forest Regressor model, cross-validation once with folds fitted in parallel
+if registered:
+    model = registered.model
+    cv_results = registered.cv_results()
+else:
+    start = time.perf_counter()
+    model = RandomForestRegressor(**params)
+    model.fit(x_train, y_train)
+    fit_time = time.perf_counter() - start
+    cv_results = cross_validate_model(RandomForestRegressor(**params), x_train, y_train, cv=5)
 
 # Evaluate the model
-y_pred = model.predict(x_test)
-mse = mean_squared_error(y_test, y_pred)
-r2 = r2_score(y_test, y_pred)
-print("------ Random Forest regression ------")
-print(f"Mean Squared Error: {mse}")
-print(f"R-squared: {r2}")
-
-# Cross-validation
-cv_scores = cross_val_score(model, x_train, y_train, cv=5, scoring='r2')
-print(f"Cross-Validated R-squared Scores: {cv_scores}")
-print(f"Mean R-squared: {cv_scores.mean()}")
+test_metrics = regression_metrics(y_test, model.predict(x_test))
+print_results("Random Forest regression", test_metrics, cv_results)
+if not registered:#loaded by predict_service.py through models/models.yaml
+    register_model('RandomForest', model, encoder, data_version, params, test_metrics, cv_results, fit_time, x_train.shape[0])
 
 # Feature importance
 feature_importances = pd.DataFrame({
@@ -73,15 +72,5 @@ plt.title("Random Forest Feature Importances")
 plt.gca().invert_yaxis()
 plt.show()
 
-output_dir ='/home/tomas/GitHub/ITHS-AI/data/'
-results_file_path = os.path.join(output_dir, "RandomForest-results.txt")
-with open(results_file_path, "w") as results_file:
-    results_file.write("------ Random Forest Regression Results ------\n")
-    results_file.write(f"Mean Squared Error: {mse:.4f}\n")
-    results_file.write(f"R-squared: {r2:.4f}\n")
-    results_file.write("\nCross-Validation Results:\n")
-    cv_scores = cross_val_score(model, x_train, y_train, cv=5, scoring='r2')
-    results_file.write(f"Cross-Validated R-squared Scores: {', '.join(f'{score:.4f}' for score in cv_scores)}\n")
-    results_file.write(f"Mean R-squared: {cv_scores.mean():.4f}\n")
-
-print(f"Regression results saved to {results_file_path}")
+results_file_path = os.path.join(ConfigLoader().get_data_dir(), "RandomForest-results.txt")
+write_results(results_file_path, "Random Forest Regression Results", test_metrics, cv_results)
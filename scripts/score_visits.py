@@ -0,0 +1,107 @@
+import argparse
+import os
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config_loader import ConfigLoader
+from features import ACTIVITY_FEATURE
+from model_registry import get_model
+from predict_service import FIELD_ALIASES
+
+CHUNK_ROWS = 50000 # visits encoded and predicted at a time, bounds memory whatever the input size
+ID_COLUMNS = ['visitId', 'CareEpisodeID_x', 'TravelToVisitStarted.StartTime', 'date'] # read from the processed dataset next to the features, schedules keep all their columns
+ID_DTYPES = {'visitId': 'str', 'CareEpisodeID_x': 'Int64', 'CareEpisodeID': 'Int64'} # fixed CSV types, so every chunk gets the schema of the first
+DATE_COLUMNS = ['TravelToVisitStarted.StartTime', 'date']
+PREDICTION_COLUMN = 'PredictedDurationMin'
+
+def encoder_columns(encoder):#input columns a fitted VisitFeatureEncoder reads
+    return ([ACTIVITY_FEATURE] if encoder.target_encode_activity else []) + list(encoder.categorical_features) + list(encoder.numeric_features)
+
+def level_dtype(levels):#CSV dtype that parses back to the encoder's fitted levels (bool/int/float/text)
+    if levels and all(isinstance(level, (bool, np.bool_)) for level in levels):
+        return 'boolean'
+    if levels and all(isinstance(level, (int, np.integer)) for level in levels):
+        return 'Int64'
+    if levels and all(isinstance(level, (float, np.floating)) for level in levels):
+        return 'float64'
+    return 'str'
+
+def csv_dtypes(encoder):#whatever a chunk holds, features and ids always read as these, any other schedule column as text
+    dtypes = dict(ID_DTYPES)
+    dtypes[ACTIVITY_FEATURE] = 'str'
+    for column in encoder.categorical_features:
+        dtypes[column] = level_dtype(encoder.categories_[column])
+    for column in encoder.numeric_features:
+        dtypes[column] = 'float64'
+    dtypes.update({alias: dtypes[name] for alias, name in FIELD_ALIASES.items() if name in dtypes})
+    return defaultdict(lambda: 'str', {column: dtype for column, dtype in dtypes.items() if column not in DATE_COLUMNS})
+
+def read_visit_chunks(path, chunk_rows=CHUNK_ROWS, feature_columns=(), dtypes=None):#processed Parquet or a schedule (CSV/Parquet), schedule columns may use the short predict_service names
+    csv = not path.endswith('.parquet')
+    if not csv:
+        parquet = pq.ParquetFile(path)
+        names = parquet.schema_arrow.names
+        columns = None
+        if 'Information' in names:#the processed dataset, only the features and ids are read
+            columns = [name for name in names if name in set(feature_columns) | set(ID_COLUMNS)]
+        chunks = (batch.to_pandas() for batch in parquet.iter_batches(batch_size=chunk_rows, columns=columns))
+    else:
+        chunks = pd.read_csv(path, chunksize=chunk_rows, dtype=dtypes)#without dtype each chunk guesses its own types (an empty gender reads as float)
+    for chunk in chunks:
+        chunk = chunk.rename(columns=FIELD_ALIASES)
+        if csv:
+            for column in chunk.columns.intersection(DATE_COLUMNS):
+                chunk[column] = pd.to_datetime(chunk[column]).astype('datetime64[ns]')#an all-empty chunk would otherwise get another unit
+        yield chunk
+
+def score_visits(input_path, output_path, model_name='RandomForest', chunk_rows=CHUNK_ROWS, n_jobs=-1):#predicted duration per visit, written chunk by chunk to Parquet
+    registered = get_model(model_name)
+    if registered is None:
+        raise FileNotFoundError(f"No trained '{model_name}' model in the registry, run its training script first")
+    model = registered.model
+    if hasattr(model, 'n_jobs'):
+        model.n_jobs = n_jobs#trees of one chunk predicted in parallel
+    encoder = registered.encoder
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    writer = None
+    rows = 0
+    start = time.perf_counter()
+    try:
+        features = encoder_columns(encoder)
+        for chunk in read_visit_chunks(input_path, chunk_rows, features, csv_dtypes(encoder)):
+            predictions = model.predict(encoder.transform(chunk.reindex(columns=features)))#missing feature columns score as unknown levels
+            scored = chunk.copy()
+            scored[PREDICTION_COLUMN] = np.asarray(predictions, dtype=np.float32)
+            table = pa.Table.from_pandas(scored, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table.cast(writer.schema))#same types, but categories (dictionaries) differ from batch to batch
+            rows += len(scored)
+            print(f"{rows} visits scored, {rows / (time.perf_counter() - start):.0f} rows/s")
+    finally:
+        if writer is not None:
+            writer.close()
+    elapsed = time.perf_counter() - start
+    print(f"Scored {rows} visits with {model_name} in {elapsed:.2f} s ({rows / elapsed if elapsed else 0:.0f} rows/s) -> {output_path}")
+    return {'rows': rows, 'seconds': elapsed, 'rows_per_s': rows / elapsed if elapsed else None}
+
+if __name__ == "__main__":
+    config = ConfigLoader()
+    settings = config.config.get('bulk_scoring', {})
+    parser = argparse.ArgumentParser(description="Predict visit durations for a whole processed dataset or schedule file")
+    parser.add_argument('input', nargs='?', help="CSV or Parquet of visits, defaults to the processed dataset")
+    parser.add_argument('--output', help="Parquet file, defaults to data/<input name>-predictions.parquet")
+    parser.add_argument('--model', default=settings.get('model', 'RandomForest'), help="models/models.yaml entry")
+    parser.add_argument('--chunk-rows', type=int, default=settings.get('chunk_rows', CHUNK_ROWS))
+    parser.add_argument('--n-jobs', type=int, default=settings.get('n_jobs', -1))
+    args = parser.parse_args()
+
+    input_path = args.input or config.get_processed_file_path()
+    output_path = args.output or os.path.join(config.get_data_dir(), f"{os.path.splitext(os.path.basename(input_path))[0]}-predictions.parquet")
+    score_visits(input_path, output_path, args.model, args.chunk_rows, args.n_jobs)
@@ -0,0 +1,65 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (registers HalvingRandomSearchCV)
+from sklearn.model_selection import HalvingRandomSearchCV, KFold, train_test_split
+
+from config_loader import MODELS_DIR, ConfigLoader
+from dataset import MODEL_COLUMNS, load_processed_data
+from features import TARGET, VisitFeatureEncoder
+
+# Successive halving (Hyperband-style) over the forest size: many cheap small forests first, only the best get more trees
+def tune_random_forest(df, tuning, base_params):
+    encoder = VisitFeatureEncoder().fit(df, df[TARGET])
+    features = encoder.transform(df).to_numpy(dtype=np.float32)#encoded once, every candidate and fold reuses the same matrix
+    target = df[TARGET].to_numpy(dtype=float)
+    x_train, _, y_train, _ = train_test_split(features, target, test_size=0.2, random_state=4562)#same hold-out as randomForest.py, never seen while tuning
+
+    folds = list(KFold(n_splits=tuning.get('cv', 5), shuffle=True, random_state=tuning.get('random_state', 42)).split(x_train))#fixed folds shared by all candidates
+    estimator_params = {key: value for key, value in base_params.items() if key != 'n_estimators'}
+    estimator_params['n_jobs'] = 1#parallelism is across candidates x folds, not inside a forest
+    search = HalvingRandomSearchCV(
+        RandomForestRegressor(**estimator_params),
+        param_distributions=tuning['space'],
+        n_candidates=tuning.get('n_candidates', 64),
+        factor=tuning.get('factor', 3),
+        resource='n_estimators',
+        min_resources=tuning.get('min_resources', 16),
+        max_resources=tuning.get('max_resources', 432),
+        cv=folds,
+        scoring='r2',
+        n_jobs=tuning.get('n_jobs', -1),
+        random_state=tuning.get('random_state', 42),
+        refit=False,
+    )
+    search.fit(x_train, y_train)
+
+    leaderboard = pd.DataFrame(search.cv_results_)
+    leaderboard = leaderboard[['iter', 'n_resources', 'params', 'mean_test_score', 'std_test_score', 'mean_fit_time', 'rank_test_score']]
+    leaderboard = leaderboard.sort_values(['iter', 'rank_test_score'], ascending=[False, True]).reset_index(drop=True)
+    best_params = dict(search.best_params_, n_estimators=int(search.best_params_['n_estimators']))
+    return best_params, search.best_score_, leaderboard
+
+if __name__ == "__main__":
+    config = ConfigLoader()
+    random_forest_config = config.config['random_forest']
+    df = load_processed_data(columns=MODEL_COLUMNS)
+    df = df[df['Information'] == 'match']
+
+    start = time.perf_counter()
+    best_params, best_score, leaderboard = tune_random_forest(df, random_forest_config['tuning'], random_forest_config.get('params') or {})
+    cv_folds = random_forest_config['tuning'].get('cv', 5)
+    print(f"Search took {time.perf_counter() - start:.1f}s over {len(leaderboard)} candidate-rounds x {cv_folds} folds = {len(leaderboard) * cv_folds} fits")
+    print(f"Best cross-validated R-squared: {best_score:.4f}")
+    print(f"Best params: {best_params}")
+
+    leaderboard_path = os.path.join(config.get_data_dir(), "RandomForest-tuning.csv")
+    leaderboard.to_csv(leaderboard_path, index=False)
+    best_params_path = os.path.join(MODELS_DIR, "random_forest-best-params.yaml")
+    with open(best_params_path, 'w') as file:
+        yaml.safe_dump(best_params, file)
+    print(f"Leaderboard saved to {leaderboard_path}, best params saved to {best_params_path}")
@@ -1,8 +1,23 @@
-import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import yaml
 import os
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.colors import LogNorm
+from matplotlib.figure import Figure
+
+from config_loader import ConfigLoader
+from dataset import load_processed_data
+
+EPISODE_COLUMN = 'CareEpisodeID_x' # save_results merges two CareEpisodeID columns, the visit's keeps the _x suffix
+HIST_BINS = 50
+DENSITY_BINS = 100 # per axis of the distance vs duration 2D histogram
+TOP_EPISODES = 40 # episodes (most visits first) shown in the per-episode chart
+MAX_OUTLIERS = 2000 # box plot fliers drawn, spread over the whole range
+
+# Configure Seaborn
+sns.set(style="whitegrid")
 
 def load_config(config_path):
     with open(config_path, 'r') as file:
@@ -26,69 +41,106 @@ def save_plot(plt_object, filename, output_dir):
     plt_object.savefig(file_path)
     print(f"Plot saved to {file_path}")
 
-if __name__ == "__main__":
-    config_path = (
-        "/Users/tomas/Documents/GitHub/AImed/config/config.yaml"
-        if os.uname().sysname == 'Darwin' else
-        "/home/tomas/GitHub/AImed/config/config.yaml"
-    )
+# Everything is aggregated once in the parent with numpy/pandas, the figures only ever see bins and summaries
+def histogram(values, bins=HIST_BINS):
+    values = values.dropna().to_numpy()
+    counts, edges = np.histogram(values, bins=bins)
+    return {'counts': counts, 'edges': edges}
+
+def box_stats(values, max_outliers=MAX_OUTLIERS):#what Axes.bxp draws, Tukey whiskers at 1.5 IQR
+    values = values.dropna().to_numpy()
+    q1, median, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    fliers = np.sort(values[(values < q1 - 1.5 * iqr) | (values > q3 + 1.5 * iqr)])
+    if len(fliers) > max_outliers:
+        fliers = fliers[np.linspace(0, len(fliers) - 1, max_outliers).astype(int)]
+    return {'med': median, 'q1': q1, 'q3': q3, 'whislo': inside.min(), 'whishi': inside.max(), 'fliers': fliers, 'label': ''}
+
+def density(x, y, bins=DENSITY_BINS):
+    valid = x.notna() & y.notna()
+    counts, x_edges, y_edges = np.histogram2d(x[valid].to_numpy(), y[valid].to_numpy(), bins=bins)
+    return {'counts': counts, 'x_edges': x_edges, 'y_edges': y_edges}
+
+def episode_summary(df, top=TOP_EPISODES):#count/mean/quartiles per episode, the busiest ones only
+    grouped = df.groupby(EPISODE_COLUMN, observed=True)['DurationMin']
+    summary = grouped.agg(['count', 'mean', 'median']).join(grouped.quantile([0.25, 0.75]).unstack().rename(columns={0.25: 'q1', 0.75: 'q3'}))
+    return summary.sort_values('count', ascending=False).head(top)
+
+def plot_histogram(ax, data, title, xlabel):
+    ax.stairs(data['counts'], data['edges'], fill=True, alpha=0.7)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel('Frequency')
+
+def plot_box(ax, data, title, xlabel):
+    ax.bxp([data], orientation='horizontal', showfliers=True)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
 
-    config = '/Users/tomas/Documents/GitHub/ITHS-AI-Project/config/config.yaml'
-    data_path ='/Users/tomas/Documents/GitHub/ITHS-AI-Project/data/df.xlsx'
-    output_dir = '/Users/tomas/Documents/GitHub/ITHS-AI-Project/data/'
+def plot_density(ax, data, title, xlabel, ylabel):
+    mesh = ax.pcolormesh(data['x_edges'], data['y_edges'], np.ma.masked_equal(data['counts'].T, 0), norm=LogNorm(), cmap='viridis')
+    ax.figure.colorbar(mesh, ax=ax, label='Visits')
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+
+def plot_episodes(ax, data, title, xlabel, ylabel):
+    labels = [str(episode) for episode in data.index]
+    ax.barh(labels, data['mean'], xerr=[(data['mean'] - data['q1']).clip(lower=0), (data['q3'] - data['mean']).clip(lower=0)], alpha=0.8)
+    ax.invert_yaxis()
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+
+PLOTTERS = {'histogram': plot_histogram, 'box': plot_box, 'density': plot_density, 'episodes': plot_episodes}
+
+def figure_specs(df, bins=HIST_BINS, density_bins=DENSITY_BINS, top_episodes=TOP_EPISODES):#(file name, figure size, plot kind, aggregated data, labels) per figure
+    return [
+        ("distribution_of_travel_durations.png", (10, 6), 'histogram', histogram(df['DurationMin'], bins), ('Distribution of Travel Durations', 'Travel Duration (minutes)')),
+        ("box_plot_travel_durations.png", (10, 6), 'box', box_stats(df['DurationMin']), ('Box Plot of Travel Durations', 'Travel Duration (minutes)')),
+        ("density_distance_vs_duration.png", (12, 8), 'density', density(df['DistanceM'], df['DurationMin'], density_bins), ('Travel Duration vs. Travel Distance', 'Travel Distance (meters)', 'Travel Duration (minutes)')),
+        ("bar_plot_average_duration_by_episode.png", (14, 8), 'episodes', episode_summary(df, top_episodes), (f'Average Travel Duration, {top_episodes} Busiest Care Episodes (IQR bars)', 'Average Travel Duration (minutes)', 'Care Episode ID')),
+        ("distribution_of_travel_distances.png", (10, 6), 'histogram', histogram(df['DistanceM'], bins), ('Distribution of Travel Distances', 'Travel Distance (meters)')),
+    ]
+
+def render_figure(spec, output_dir):#runs in a worker, Figure() keeps pyplot (and any GUI backend) out of it
+    filename, size, kind, data, labels = spec
+    figure = Figure(figsize=size)
+    PLOTTERS[kind](figure.add_subplot(), data, *labels)
+    figure.tight_layout()
+    file_path = os.path.join(output_dir, filename)
+    figure.savefig(file_path)
+    return file_path
+
+def render_report(df, output_dir, workers=None, **aggregation):#all figures written to output_dir in parallel, returns their paths
+    specs = figure_specs(df, **aggregation)
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(render_figure, specs, [output_dir] * len(specs)))
+
+if __name__ == "__main__":
+    config = ConfigLoader()
+    settings = config.config.get('visualiser', {})
+    data_path = config.get_processed_file_path()
+    output_dir = settings.get('output_dir') or os.path.join(config.get_data_dir(), 'plots')
+    aggregation = {'bins': settings.get('bins', HIST_BINS), 'density_bins': settings.get('density_bins', DENSITY_BINS), 'top_episodes': settings.get('top_episodes', TOP_EPISODES)}
 
     try:
-        df = pd.read_excel(data_path, engine='openpyxl')  # Use openpyxl for reading Excel files
+        df = load_processed_data(data_path, columns=[EPISODE_COLUMN, 'DurationMin', 'DistanceM'])
         print(f"Data successfully loaded from {data_path}")
     except Exception as e:
-        print(f"Error reading the Excel file: {e}")
+        print(f"Error reading the processed data: {e}")
         exit()
 
-    # Configure Seaborn
-    sns.set(style="whitegrid")
-
-    # 1. Distribution of Travel Durations
-    plt.figure(figsize=(10, 6))
-    sns.histplot(df['DurationMin'], bins=50, kde=True)
-    plt.title('Distribution of Travel Durations')
-    plt.xlabel('Travel Duration (minutes)')
-    plt.ylabel('Frequency')
-    save_plot(plt, "distribution_of_travel_durations.png", output_dir)
-    plt.show()
-
-    # 2. Box Plot to Identify Outliers in Travel Durations
-    plt.figure(figsize=(10, 6))
-    sns.boxplot(x=df['DurationMin'])
-    plt.title('Box Plot of Travel Durations')
-    plt.xlabel('Travel Duration (minutes)')
-    save_plot(plt, "box_plot_travel_durations.png", output_dir)
-    plt.show()
-
-    # 3. Scatter Plot: Distance vs. Duration
-    plt.figure(figsize=(12, 8))
-    sns.scatterplot(x='DistanceM', y='DurationMin', data=df)
-    plt.title('Travel Duration vs. Travel Distance')
-    plt.xlabel('Travel Distance (meters)')
-    plt.ylabel('Travel Duration (minutes)')
-    save_plot(plt, "scatter_distance_vs_duration.png", output_dir)
-    plt.show()
-
-    # 4. Bar Plot of Average Travel Duration by Care Episode
-    plt.figure(figsize=(14, 8))
-    average_duration_by_episode = df.groupby('CareEpisodeID')['DurationMin'].mean().reset_index()
-    sns.barplot(x='CareEpisodeID', y='DurationMin', data=average_duration_by_episode)
-    plt.xticks(rotation=90)
-    plt.title('Average Travel Duration by Care Episode')
-    plt.xlabel('Care Episode ID')
-    plt.ylabel('Average Travel Duration (minutes)')
-    save_plot(plt, "bar_plot_average_duration_by_episode.png", output_dir)
-    plt.show()
-
-    # 5. Distribution of Travel Distances
-    plt.figure(figsize=(10, 6))
-    sns.histplot(df['DistanceM'], bins=50, kde=True)
-    plt.title('Distribution of Travel Distances')
-    plt.xlabel('Travel Distance (meters)')
-    plt.ylabel('Frequency')
-    save_plot(plt, "distribution_of_travel_distances.png", output_dir)
-    plt.show()
+    if settings.get('headless', True):#batch report: no windows, figures rendered side by side
+        for file_path in render_report(df, output_dir, workers=settings.get('workers'), **aggregation):
+            print(f"Plot saved to {file_path}")
+    else:#same figures one after another, shown together at the end
+        os.makedirs(output_dir, exist_ok=True)
+        for filename, size, kind, data, labels in figure_specs(df, **aggregation):
+            plt.figure(figsize=size)
+            PLOTTERS[kind](plt.gca(), data, *labels)
+            plt.tight_layout()
+            save_plot(plt, filename, output_dir)
+        plt.show()